@@ -1,7 +1,9 @@
 import cmath
-from lark import Lark, InlineTransformer
+from lark import Transformer, Tree, v_args
+from constant_folding import ArithmeticFolder, is_const, tree_size
+from grammar_cache import cached_parse, load_parser
 
-grammar = Lark(
+grammar = load_parser(
     r"""
 start  : expr
 
@@ -33,11 +35,16 @@ COMPLEX : INT "i"
 NAME    : ("a".."z" | "_" | "A".."Z")+
 
 %ignore " "
-"""
+""",
+    parser="lalr",
 )
 
+# parse(src) reaproveita as árvores de fontes repetidos
+parse = cached_parse(grammar.parse)
 
-class CalcTransformer(InlineTransformer):
+
+@v_args(inline=True)
+class CalcTransformer(Transformer):
     from operator import add, sub, mul, truediv as div, pow, neg, pos
     names = {
         "pi": cmath.pi, 
@@ -72,13 +79,61 @@ class CalcTransformer(InlineTransformer):
     def assign(self, name, value):
         self.env[name] = value
 
+    def const(self, value):
+        return value
+
+
+@v_args(inline=True)
+class ConstantFolder(ArithmeticFolder):
+    """
+    Calcula antecipadamente as subárvores que só envolvem números, nomes
+    constantes de CalcTransformer.names e funções aplicadas a constantes,
+    além das identidades tratadas por ArithmeticFolder.
+    """
+
+    def INT(self, tk):
+        return Tree("const", [int(tk)])
+
+    def COMPLEX(self, tk):
+        return Tree("const", [int(tk[:-1]) * 1j])
+
+    def name(self, tk):
+        value = CalcTransformer.names.get(str(tk))
+        if value is None or callable(value):
+            return Tree("name", [tk])
+        return Tree("const", [value])
+
+    def func(self, name, arg):
+        fn = CalcTransformer.names.get(str(name))
+        if callable(fn) and is_const(arg):
+            try:
+                return Tree("const", [fn(arg.children[0])])
+            except Exception:
+                pass
+        return Tree("func", [name, arg])
+
+
+def fold_constants(tree: Tree) -> tuple:
+    """
+    Aplica ConstantFolder e retorna a nova árvore e o número de nós
+    removidos.
+    """
+    folded = ConstantFolder().transform(tree)
+    return folded, tree_size(tree) - tree_size(folded)
+
 
 transformer = CalcTransformer()
 # exemplos = '40 2 +', '3 2 - 1 -', '2 10 4 * +', '4 3 2 ^ ^'
-exemplos = "x = 1; x + 1", # "2 * pi", "e^1", "3 + 2i", '3 - 2 - (-1)', '(2 + 10) * 4', '4 ^ 3 ^ 2'
+# "x = 1; x + 1" ainda não é aceito pela gramática
+exemplos = "2 * pi", "e^1", "3 + 2i", '3 - 2 - (-1)', '(2 + 10) * 4', '4 ^ 3 ^ 2'
 
 for src in exemplos:
-    tree = grammar.parse(src)
+    tree = parse(src)
     print(src)
     print(tree.pretty())
-    print(transformer.transform(tree).pretty())
\ No newline at end of file
+    print(transformer.transform(tree).pretty())
+    folded, removed = fold_constants(tree)
+    print(f"{removed} nós removidos:", folded)
+
+# Sem saber se x é um número, x * 1 fica como está
+assert fold_constants(parse("x * 1"))[0].children[0].data == "mul"
@@ -1,7 +1,7 @@
-from lark import Lark
+from grammar_cache import load_parser
 
 
-grammar = Lark(r"""
+grammar = load_parser(r"""
 module  : "\n"* [stm ("\n"+ stm)* "\n"*]
 
 ?stm    : assign
@@ -21,7 +21,7 @@ VAR     : ("a".."z"|"ç")+
 STRING  : "\"" ("a".."z"|"A".."Z"|" ")* "\""
 
 %ignore " "+
-""", start="module")
+""", start="module", parser="lalr")
 
 code = """
 ç = "Noam Chomsky"
@@ -1,8 +1,18 @@
-from typing import Tuple, Callable, Any, List, Union
+import re
+from contextvars import ContextVar
+from typing import Tuple, Callable, Any, List, Union, Optional, FrozenSet, NamedTuple
+
+from json_common import Records, cache_key, compact, unescape
 
 ST = Tuple[int, str]
+Result = Optional[Tuple[ST, Any]]
 AnyParser = Union["Parser", str]
 
+# Conjunto FIRST de um parser: os caracteres que podem iniciar uma leitura bem
+# sucedida (None se desconhecidos) e se ele pode ter sucesso sem consumir nada.
+First = Tuple[Optional[FrozenSet[str]], bool]
+UNKNOWN: First = (None, True)
+
 
 class Parser:
     """
@@ -10,8 +20,21 @@ class Parser:
     Parser.parse().
     """
 
-    def __init__(self, func: Callable[[ST], Tuple[ST, Any]]):
+    def __init__(
+        self,
+        func: Callable[[ST], Result],
+        kind: str = "function",
+        args: tuple = (),
+        first: Optional[First] = None,
+        expected: Optional[str] = None,
+        regex: Optional[Tuple[str, Callable]] = None,
+    ):
         self.function = func
+        self.kind = kind
+        self.args = args
+        self.first_set = first
+        self.expected = expected
+        self.regex = regex
 
     def __or__(self, other: AnyParser):
         # self | other
@@ -24,12 +47,13 @@ class Parser:
 
         second = as_parser(other)
 
-        def parser(st: ST) -> Tuple[ST, Any]:
-            st, __ = self.parse(st)
-            st, v2 = second.parse(st)
-            return st, v2
+        def parser(st: ST) -> Result:
+            res = self.run(st)
+            if res is FAIL:
+                return FAIL
+            return second.run(res[0])
 
-        return Parser(parser)
+        return Parser(parser, "rshift", (self, second))
 
     def __rrshift__(self, other):
         # other >> self
@@ -42,12 +66,17 @@ class Parser:
 
         second = as_parser(other)
 
-        def parser(st: ST) -> Tuple[ST, Any]:
-            st, v1 = self.parse(st)
-            st, __ = second.parse(st)
-            return st, v1
+        def parser(st: ST) -> Result:
+            res = self.run(st)
+            if res is FAIL:
+                return FAIL
+            st, v1 = res
+            res = second.run(st)
+            if res is FAIL:
+                return FAIL
+            return res[0], v1
 
-        return Parser(parser)
+        return Parser(parser, "lshift", (self, second))
 
     def __rlshift__(self, other):
         # other << self
@@ -68,41 +97,220 @@ class Parser:
 
         sep_parser = as_parser(sep)
 
-        def parser(st: ST) -> Tuple[ST, list]:
-            try:
-                st, x = self.parse(st)
-            except SyntaxError:
+        def parser(st: ST) -> Result:
+            res = self.run(st)
+            if res is FAIL:
                 return st, []
 
+            st, x = res
             elems = [x]
             while True:
-                try:
-                    st, _ = sep_parser.parse(st)
-                except SyntaxError:
+                res = sep_parser.run(st)
+                if res is FAIL:
                     return st, elems
 
-                st, x = self.parse(st)
+                res = self.run(res[0])
+                if res is FAIL:
+                    return FAIL
+                st, x = res
                 elems.append(x)
 
-        return Parser(parser)
+        return Parser(parser, "sep_by", (self, sep_parser))
 
     def map(self, fn: Callable) -> "Parser":
         """
         Aplica a função no resultado obtido pelo parser.
         """
 
-        def parser(st: ST) -> Tuple[ST, list]:
-            st, x = self.parse(st)
-            return st, fn(x)
+        def parser(st: ST) -> Result:
+            res = self.run(st)
+            if res is FAIL:
+                return FAIL
+            return res[0], fn(res[1])
 
-        return Parser(parser)
+        return Parser(parser, "map", (self, fn))
 
-    def parse(self, st: ST) -> Tuple[ST, Any]:
+    def first(self) -> First:
+        """
+        Calcula (e guarda) o conjunto FIRST do parser a partir da estrutura
+        dos combinadores que o formam.
+        """
+        if self.first_set is None:
+            # Valor provisório interrompe ciclos em gramáticas recursivas
+            self.first_set = UNKNOWN
+            self.first_set = compute_first(self)
+        return self.first_set
+
+    def describe(self, seen: Optional[set] = None) -> Tuple[str, ...]:
+        """
+        Lista o que este parser espera encontrar na entrada, usado nas
+        mensagens de erro.
+        """
+        if self.expected is not None:
+            return (self.expected,)
+        seen = set() if seen is None else seen
+        if self in seen:
+            return ()
+        seen.add(self)
+
+        kind, args = self.kind, self.args
+        if kind in ("rshift", "lshift", "join"):
+            parsers = args[0] if kind == "join" else args
+            result = ()
+            for p in parsers:
+                result += p.describe(seen)
+                if not p.first()[1]:
+                    break
+            return result
+        elif kind in ("map", "sep_by"):
+            return args[0].describe(seen)
+        elif kind == "anyof":
+            return sum((p.describe(seen) for p in args[0]), ())
+        return ()
+
+    def compile(self) -> "Parser":
+        """
+        Compila o grafo de combinadores a partir deste parser numa função
+        Python especializada e retorna um Parser equivalente.
+
+        Em caso de falha, o parser original é executado de novo para
+        registrar a mesma mensagem de erro.
+        """
+        function = Compiler().compile(self)
+        interpreted = self.function
+
+        def parser(st: ST) -> Result:
+            pos, src = st
+            res = function(src, pos)
+            if res is FAIL:
+                return interpreted(st)
+            return (res[0], src), res[1]
+
+        return Parser(parser, "compiled", (self,), first=self.first())
+
+    def run(self, st: ST) -> Result:
+        """
+        Executa parser a partir do estado fornecido e retorna uma tupla com o
+        novo estado e o valor lido, ou FAIL caso a leitura falhe.
+
+        É o protocolo usado internamente pelos combinadores: nenhuma exceção é
+        criada quando uma alternativa falha.
+        """
+        memo = active_memo.get()
+        if memo is None:
+            return self.function(st)
+        return memo.run(self, st)
+
+    def parse(self, st: ST, memo: Optional["Memo"] = None) -> Tuple[ST, Any]:
         """
         Executa parser a partir do estado fornecido e retorna uma tupla com o
         novo estado e o valor lido.
+
+        Se "memo" for fornecido, a leitura usa o modo packrat com essa tabela.
+        Ela vale apenas para esta chamada, assim como o registro da falha mais
+        distante: leituras aninhadas ou em outras threads não os enxergam.
+
+        Lança SyntaxError apontando a posição mais distante alcançada caso a
+        leitura falhe.
         """
-        return self.function(st)
+        failure_token = active_failure.set(Failure())
+        token = active_memo.set(memo)
+        try:
+            res = self.run(st)
+            if res is FAIL:
+                raise error(st)
+        finally:
+            active_memo.reset(token)
+            active_failure.reset(failure_token)
+        return res
+
+
+def compute_first(parser: Parser) -> First:
+    """
+    Conjunto FIRST de um parser, segundo o combinador que o criou.
+    """
+    kind, args = parser.kind, parser.args
+    if kind == "literal":
+        lit = args[0]
+        return frozenset(lit[:1]), lit == ""
+    elif kind in ("rshift", "lshift"):
+        return first_of_sequence(args)
+    elif kind == "join":
+        return first_of_sequence(args[0])
+    elif kind == "map":
+        return args[0].first()
+    elif kind == "sep_by":
+        return args[0].first()[0], True
+    elif kind == "anyof":
+        chars, nullable = frozenset(), False
+        for p in args[0]:
+            p_chars, p_nullable = p.first()
+            chars = None if chars is None or p_chars is None else chars | p_chars
+            nullable = nullable or p_nullable
+        return chars, nullable
+    return UNKNOWN
+
+
+def first_of_sequence(parsers: List[Parser]) -> First:
+    """
+    Conjunto FIRST de parsers executados em sequência.
+    """
+    chars = frozenset()
+    for p in parsers:
+        p_chars, nullable = p.first()
+        chars = None if chars is None or p_chars is None else chars | p_chars
+        if not nullable:
+            return chars, False
+    return chars, True
+
+
+class Memo:
+    """
+    Tabela de memoização do modo packrat.
+
+    Guarda o resultado (ou a falha) de cada parser em cada posição, de modo que
+    o backtracking de anyof() nunca refaz a mesma leitura. A tabela é limitada
+    a "maxsize" entradas: quando enche, descarta as entradas mais antigas, que
+    correspondem às posições mais atrás no texto e dificilmente serão
+    consultadas de novo.
+
+    Junto com cada resultado fica a falha mais distante registrada durante a
+    leitura, que é registrada de novo a cada consulta. Assim a mensagem de
+    erro não depende do modo packrat, mesmo que a tabela seja reaproveitada
+    entre chamadas a Parser.parse() sobre o mesmo texto.
+    """
+
+    def __init__(self, maxsize: int = 65536):
+        self.maxsize = maxsize
+        self.table = {}
+        self.hits = 0
+        self.misses = 0
+
+    def run(self, parser: Parser, st: ST) -> Result:
+        key = (parser, st[0])
+        try:
+            result, failed_at, expected = self.table[key]
+            self.hits += 1
+        except KeyError:
+            self.misses += 1
+            failure = active_failure.get()
+            outer_pos, outer_expected = failure.pos, failure.expected
+            failure.pos, failure.expected = -1, []
+            try:
+                result = parser.function(st)
+                failed_at, expected = failure.pos, failure.expected
+            finally:
+                failure.pos, failure.expected = outer_pos, outer_expected
+            if len(self.table) >= self.maxsize:
+                del self.table[next(iter(self.table))]
+            self.table[key] = result, failed_at, expected
+        if failed_at >= 0:
+            fail_all((failed_at, st[1]), expected)
+        return result
+
+
+# Tabela packrat da chamada a Parser.parse() em andamento
+active_memo: ContextVar[Optional[Memo]] = ContextVar("active_memo", default=None)
 
 
 def as_parser(obj: AnyParser) -> Parser:
@@ -114,8 +322,66 @@ def as_parser(obj: AnyParser) -> Parser:
         raise TypeError
 
 
-def error(st, msg):
-    return SyntaxError(msg)
+class Failure:
+    """
+    Registra a posição mais distante onde algum parser falhou e o que era
+    esperado ali.
+
+    Os parsers apenas atualizam este registro e retornam FAIL. A mensagem de
+    erro só é construída, por error(), quando a leitura inteira falha.
+    """
+
+    def __init__(self):
+        self.pos = -1
+        self.expected = []
+
+
+# Sentinela retornado por um parser que falhou
+FAIL: Any = None
+
+# Falhas da chamada a Parser.parse() em andamento. Fora de parse(), como
+# quando run() é chamado diretamente, elas vão para um registro avulso.
+active_failure: ContextVar[Failure] = ContextVar("active_failure", default=Failure())
+
+
+def fail(st: ST, expected: str) -> Result:
+    """
+    Registra que "expected" era esperado no estado "st" e retorna FAIL.
+    """
+    failure = active_failure.get()
+    pos = st[0]
+    if pos > failure.pos:
+        failure.pos = pos
+        failure.expected.clear()
+    if pos == failure.pos:
+        failure.expected.append(expected)
+    return FAIL
+
+
+def fail_all(st: ST, expected: Tuple[str, ...]) -> Result:
+    """
+    Como fail(), mas registra várias expectativas de uma vez.
+    """
+    failure = active_failure.get()
+    pos = st[0]
+    if pos > failure.pos:
+        failure.pos = pos
+        failure.expected.clear()
+    if pos == failure.pos:
+        failure.expected.extend(expected)
+    return FAIL
+
+
+def error(st: ST) -> SyntaxError:
+    """
+    Cria um SyntaxError descrevendo a falha mais distante registrada.
+    """
+    failure = active_failure.get()
+    pos, src = failure.pos, st[1]
+    if pos < 0:
+        pos = st[0]
+    expected = " or ".join(dict.fromkeys(failure.expected)) or "valid input"
+    return SyntaxError(f"expect {expected} at {pos}, got {src[pos:pos + 10]!r}")
 
 
 def literal(lit: str, value=None) -> Parser:
@@ -123,34 +389,338 @@ def literal(lit: str, value=None) -> Parser:
     Lê um valor literal "lit" e retorna "value" se bem sucedido
     """
 
-    def parser(st: ST) -> Tuple[ST, Any]:
+    expected = repr(lit)
+
+    def parser(st: ST) -> Result:
         pos, src = st
 
         if src.startswith(lit, pos):
             st = (pos + len(lit), src)
             return st, value
         else:
-            raise error(st, f"expect {lit!r}!")
+            return fail(st, expected)
 
-    return Parser(parser)
+    return Parser(parser, "literal", (lit, value), expected=expected)
 
 
 def anyof(parsers: List[Parser]) -> Parser:
     """
     Testa cada parser na lista e retorna o resultado do primeiro parser bem
     sucedido.
+
+    Usa o conjunto FIRST de cada alternativa para testar apenas aquelas que
+    podem começar com o caractere atual. A tabela de despacho é montada na
+    primeira execução, de modo que a lista pode ser preenchida depois de
+    criado o parser (como em gramáticas recursivas), mas não deve mudar
+    após o primeiro uso.
     """
 
-    def parser(st: ST) -> Tuple[ST, Any]:
-        for parser in parsers:
-            try:
-                return parser.parse(st)
-            except SyntaxError:
-                continue
+    table = None
+    default = ()
+    expected = ()
+
+    def parser(st: ST) -> Result:
+        nonlocal table, default, expected
+        if table is None:
+            table, default = dispatch_table(parsers)
+            expected = sum((p.describe() for p in parsers), ())
+
+        pos, src = st
+        candidates = table.get(src[pos : pos + 1], default)
+        for parser in candidates:
+            res = parser.run(st)
+            if res is not FAIL:
+                return res
+        return fail_all(st, expected)
+
+    return Parser(parser, "anyof", (parsers,))
+
+
+def dispatch_table(parsers: List[Parser]) -> Tuple[dict, tuple]:
+    """
+    Mapeia cada caractere inicial para as alternativas que podem começar com
+    ele, preservando a ordem original.
+
+    Alternativas com FIRST desconhecido ou que aceitam a entrada vazia
+    entram em todas as listas e também na lista padrão, usada para os demais
+    caracteres e para o fim da entrada.
+    """
+    firsts = [p.first() for p in parsers]
+    always = [chars is None or nullable for chars, nullable in firsts]
+    default = tuple(p for p, a in zip(parsers, always) if a)
+
+    table = {}
+    for chars, _ in firsts:
+        for ch in chars or ():
+            if ch not in table:
+                table[ch] = tuple(
+                    p
+                    for p, (p_chars, _), a in zip(parsers, firsts, always)
+                    if a or ch in p_chars
+                )
+    return table, default
+
+
+class Regex(NamedTuple):
+    """
+    Folha (ou sequência de folhas) que pode ser lida com uma única regex.
+
+    O valor lido é convert(m.group(group)), se convert for fornecido, ou a
+    constante "value". Quando o padrão é apenas um texto fixo, "literal"
+    guarda esse texto para que se use str.startswith() no lugar da regex.
+    """
+
+    pattern: str
+    convert: Optional[Callable] = None
+    value: Any = None
+    group: int = 0
+    literal: Optional[str] = None
+
+
+def regex_of(parser: Parser) -> Optional[Regex]:
+    """
+    Retorna a regex equivalente ao parser, quando existir.
+    """
+    kind, args = parser.kind, parser.args
+    if kind == "literal":
+        lit, value = args
+        return Regex(re.escape(lit), value=value, literal=lit)
+    elif kind == "function" and parser.regex is not None:
+        pattern, convert = parser.regex
+        return Regex(pattern, convert)
+    elif kind in ("rshift", "lshift"):
+        items = sequence_items(parser)
+        regexes = [regex_of(p) for p, _ in items]
+        if all(rx is not None and rx.group == 0 for rx in regexes):
+            return fuse([(rx, keep) for rx, (_, keep) in zip(regexes, items)])
+    return None
+
+
+def sequence_items(parser: Parser, keep: bool = True) -> List[Tuple[Parser, bool]]:
+    """
+    Achata uma cadeia de >> e << numa lista de (parser, mantém o valor?).
+    """
+    if parser.kind == "rshift":
+        first, second = parser.args
+        return sequence_items(first, False) + sequence_items(second, keep)
+    elif parser.kind == "lshift":
+        first, second = parser.args
+        return sequence_items(first, keep) + sequence_items(second, False)
+    return [(parser, keep)]
+
+
+def fuse(items: List[Tuple[Regex, bool]]) -> Regex:
+    """
+    Funde uma sequência de folhas numa única regex, capturando o valor da
+    folha mantida quando ele depende do texto lido.
+
+    Cada folha fica num grupo atômico (?>...): como nos combinadores, o que
+    uma folha leu não é devolvido para que a seguinte tenha sucesso.
+    """
+    parts = []
+    convert, value, group = None, None, 0
+    for rx, keep in items:
+        if keep and rx.convert is not None:
+            parts.append(f"((?>{rx.pattern}))")
+            convert, group = rx.convert, 1
+        elif rx.literal is not None:
+            parts.append(rx.pattern)
+        else:
+            parts.append(f"(?>{rx.pattern})")
+        if keep and rx.convert is None:
+            value = rx.value
+
+    literal = None
+    if all(rx.literal is not None for rx, _ in items):
+        literal = "".join(rx.literal for rx, _ in items)
+    return Regex("".join(parts), convert, value, group, literal)
+
+
+class Compiler:
+    """
+    Compila um grafo de combinadores para funções Python especializadas.
+
+    Cada anyof, sep_by ou parser opaco vira uma função "pN(src, pos)" que
+    retorna (pos, valor) ou FAIL, sem empacotar o estado em tuplas ST.
+    Sequências (>> e <<), map e join são expandidos dentro da função que os
+    usa, e folhas vizinhas com regex (literais, ws, number, string) são
+    fundidas numa única regex pré-compilada.
+    """
+
+    def __init__(self):
+        self.namespace = {"FAIL": FAIL}
+        self.names = {}
+        self.pending = []
+        self.source = []
+        self.counter = 0
+
+    def compile(self, parser: Parser) -> Callable[[str, int], Any]:
+        entry = self.function(parser)
+        while self.pending:
+            self.emit_function(self.pending.pop())
+        exec("\n".join(self.source), self.namespace)
+        return self.namespace[entry]
+
+    def new_name(self, prefix: str) -> str:
+        self.counter += 1
+        return f"{prefix}{self.counter}"
+
+    def constant(self, obj: Any, prefix: str = "k") -> str:
+        name = self.new_name(prefix)
+        self.namespace[name] = obj
+        return name
+
+    def function(self, parser: Parser) -> str:
+        """
+        Nome da função gerada para o parser, agendando sua geração.
+        """
+        if parser not in self.names:
+            self.names[parser] = self.new_name("p")
+            self.pending.append(parser)
+        return self.names[parser]
+
+    def emit_function(self, parser: Parser):
+        code = [f"def {self.names[parser]}(src, pos):"]
+        kind = parser.kind
+        if kind == "anyof":
+            self.emit_anyof(parser, code)
+        elif kind == "sep_by":
+            self.emit_sep_by(parser, code)
+        elif kind == "function" and parser.regex is None:
+            fn = self.constant(parser.function, "f")
+            code.append(f"    r = {fn}((pos, src))")
+            code.append("    if r is FAIL:")
+            code.append("        return FAIL")
+            code.append("    return r[0][0], r[1]")
+        else:
+            self.emit_inline(parser, "v", code, "    ", frozenset())
+            code.append("    return pos, v")
+        self.source.extend(code)
+        self.source.append("")
+
+    def emit_match(self, rx: Regex, target: str, code: list, ind: str, on_fail: str):
+        """
+        Lê a regex na posição atual, guardando o valor em "target".
+        """
+        if rx.literal is not None:
+            lit = self.constant(rx.literal)
+            code.append(f"{ind}if not src.startswith({lit}, pos):")
+            code.append(f"{ind}    {on_fail}")
+            code.append(f"{ind}pos += {len(rx.literal)}")
+        else:
+            match = self.constant(re.compile(rx.pattern).match, "r")
+            code.append(f"{ind}m = {match}(src, pos)")
+            code.append(f"{ind}if m is None:")
+            code.append(f"{ind}    {on_fail}")
+            code.append(f"{ind}pos = m.end()")
+
+        if target != "_":
+            code.append(f"{ind}{target} = {self.value(rx)}")
+
+    def value(self, rx: Regex) -> str:
+        """
+        Expressão que calcula o valor lido por uma regex.
+        """
+        if rx.convert is None:
+            return self.constant(rx.value)
+        return f"{self.constant(rx.convert, 'f')}(m.group({rx.group}))"
 
-        raise error(st, "all parsers failed")
+    def emit_call(self, parser: Parser, target: str, code: list, ind: str, on_fail: str):
+        """
+        Executa o parser na posição atual, guardando o valor em "target".
+        """
+        rx = regex_of(parser)
+        if rx is not None:
+            return self.emit_match(rx, target, code, ind, on_fail)
+        fn = self.function(parser)
+        code.append(f"{ind}r = {fn}(src, pos)")
+        code.append(f"{ind}if r is FAIL:")
+        code.append(f"{ind}    {on_fail}")
+        code.append(f"{ind}pos, {target} = r")
+
+    def emit_inline(self, parser: Parser, target: str, code: list, ind: str, stack):
+        """
+        Expande o parser dentro da função atual. Como pode avançar "pos" em
+        vários passos, toda falha faz a função inteira retornar FAIL.
+        """
+        kind = parser.kind
+        inline = ("rshift", "lshift", "map", "join")
+        if regex_of(parser) is not None or kind not in inline or parser in stack:
+            return self.emit_call(parser, target, code, ind, "return FAIL")
+
+        stack = stack | {parser}
+        if kind == "map":
+            child, fn = parser.args
+            tmp = self.new_name("t")
+            self.emit_inline(child, tmp, code, ind, stack)
+            code.append(f"{ind}{target} = {self.constant(fn, 'f')}({tmp})")
+        elif kind == "join":
+            tmps = []
+            for child in parser.args[0]:
+                tmps.append(self.new_name("t"))
+                self.emit_inline(child, tmps[-1], code, ind, stack)
+            code.append(f"{ind}{target} = [{', '.join(tmps)}]")
+        else:
+            run = []
+            for item, keep in sequence_items(parser) + [(None, False)]:
+                rx = None if item is None else regex_of(item)
+                if rx is not None and rx.group == 0:
+                    run.append((rx, keep))
+                    continue
+                if run:
+                    run_target = target if any(k for _, k in run) else "_"
+                    self.emit_match(fuse(run), run_target, code, ind, "return FAIL")
+                    run = []
+                if item is not None:
+                    self.emit_inline(item, target if keep else "_", code, ind, stack)
+
+    def emit_anyof(self, parser: Parser, code: list):
+        parsers = parser.args[0]
+        table, default = dispatch_table(parsers)
+        groups = {}
+        for ch, candidates in table.items():
+            groups.setdefault(candidates, set()).add(ch)
+
+        code.append("    c = src[pos : pos + 1]")
+        for candidates, chars in groups.items():
+            if candidates == default:
+                continue
+            code.append(f"    if c in {self.constant(frozenset(chars))}:")
+            for alt in candidates:
+                self.emit_alternative(alt, code, "        ")
+            code.append("        return FAIL")
+        for alt in default:
+            self.emit_alternative(alt, code, "    ")
+        code.append("    return FAIL")
+
+    def emit_alternative(self, parser: Parser, code: list, ind: str):
+        """
+        Testa uma alternativa de anyof e retorna seu resultado em caso de
+        sucesso.
+        """
+        rx = regex_of(parser)
+        if rx is not None and rx.literal is not None:
+            lit = self.constant(rx.literal)
+            code.append(f"{ind}if src.startswith({lit}, pos):")
+            code.append(f"{ind}    return pos + {len(rx.literal)}, {self.value(rx)}")
+        elif rx is not None:
+            match = self.constant(re.compile(rx.pattern).match, "r")
+            code.append(f"{ind}m = {match}(src, pos)")
+            code.append(f"{ind}if m is not None:")
+            code.append(f"{ind}    return m.end(), {self.value(rx)}")
+        else:
+            code.append(f"{ind}r = {self.function(parser)}(src, pos)")
+            code.append(f"{ind}if r is not FAIL:")
+            code.append(f"{ind}    return r")
 
-    return Parser(parser)
+    def emit_sep_by(self, parser: Parser, code: list):
+        elem, sep = parser.args
+        self.emit_call(elem, "x", code, "    ", "return pos, []")
+        code.append("    elems = [x]")
+        code.append("    while True:")
+        self.emit_call(sep, "_", code, "        ", "return pos, elems")
+        self.emit_call(elem, "x", code, "        ", "return FAIL")
+        code.append("        elems.append(x)")
 
 
 def join(parsers: List[Parser]) -> Parser:
@@ -158,40 +728,64 @@ def join(parsers: List[Parser]) -> Parser:
     Executa todos parsers agregando o resultado em uma lista.
     """
 
-    def parser(st: ST) -> Tuple[ST, list]:
+    def parser(st: ST) -> Result:
         results = []
         for parser in parsers:
-            st, x = parser.parse(st)
+            res = parser.run(st)
+            if res is FAIL:
+                return FAIL
+            st, x = res
             results.append(x)
         return st, results
 
-    return Parser(parser)
+    return Parser(parser, "join", (parsers,))
+
+
+NUMBER = re.compile(r"-?(?:0|[1-9][0-9]*)(?:\.[0-9]+)?(?:[eE][+-]?[0-9]+)?")
+STRING = re.compile(r'"[^"\\]*(?:\\.[^"\\]*)*"')
+SPACES = re.compile(r"\s*")
+
 
+def to_number(st: str) -> Union[int, float]:
+    """
+    Converte o texto de um número JSON em int ou float.
+    """
+    if "." in st or "e" in st or "E" in st:
+        return float(st)
+    return int(st)
 
-def read_number(st: ST) -> Tuple[ST, int]:
+
+def read_number(st: ST) -> Result:
     """
     Lê um número.
     """
     pos, src = st
-    pos_end = pos
-    while pos_end < len(src) and src[pos_end].isdigit():
-        pos_end += 1
-    if pos == pos_end:
-        raise error(st, "not a number")
-    n = int(src[pos:pos_end])
-    return (pos_end, src), n
+    m = NUMBER.match(src, pos)
+    if m is None:
+        return fail(st, "number")
+    return (m.end(), src), to_number(m.group())
 
 
-def read_string(st: ST) -> Tuple[ST, str]:
+def unquote(st: str) -> str:
+    """
+    Remove as aspas de uma string lida pela regex de "string" e substitui
+    suas sequências de escape.
+    """
+    st = st[1:-1]
+    if "\\" in st:
+        st = unescape(st)
+    return st
+
+
+def read_string(st: ST) -> Result:
     """
     Lê uma string.
     """
     pos, src = st
-    if src[pos] != '"':
-        raise error(st, "not a string!")
-    pos_end = src.find('"', pos + 1)
-    string = src[pos + 1 : pos_end]
-    return (pos_end + 1, src), string
+    m = STRING.match(src, pos)
+    if m is None:
+        return fail(st, "string")
+    return (m.end(), src), unquote(m.group())
 
 
 def skip_spaces(st: ST) -> Tuple[ST, Any]:
@@ -199,9 +793,7 @@ def skip_spaces(st: ST) -> Tuple[ST, Any]:
     Pula espaços.
     """
     pos, src = st
-    while pos < len(src) and src[pos].isspace():
-        pos += 1
-    return (pos, src), None
+    return (SPACES.match(src, pos).end(), src), None
 
 
 def strip(parser: AnyParser) -> Parser:
@@ -210,9 +802,35 @@ def strip(parser: AnyParser) -> Parser:
     """
     return ws >> as_parser(parser) << ws
 
-number = Parser(read_number)
-string = Parser(read_string)
-ws = Parser(skip_spaces)
+# str.isspace() não reconhece nenhum caractere acima de U+3000
+WHITESPACE = frozenset(c for c in map(chr, range(0x3001)) if c.isspace())
+
+number = Parser(
+    read_number,
+    first=(frozenset("-0123456789"), False),
+    expected="number",
+    regex=(NUMBER.pattern, to_number),
+)
+string = Parser(
+    read_string,
+    first=(frozenset('"'), False),
+    expected="string",
+    regex=(STRING.pattern, unquote),
+)
+ws = Parser(skip_spaces, first=(WHITESPACE, True), regex=(SPACES.pattern, None))
+
+
+# Opções (key_cache, records) da chamada a loads() em andamento
+loads_options: ContextVar[tuple] = ContextVar("loads_options", default=(None, False))
+
+
+def shared_key(key: str) -> str:
+    return cache_key(loads_options.get()[0], key)
+
+
+def maybe_records(elements: list):
+    return compact(elements) if loads_options.get()[1] else elements
+
 
 json_options = []
 value = anyof(json_options)
@@ -221,21 +839,50 @@ false = literal("false", False)
 null = literal("null", None)
 
 elements = value.sep_by(strip(","))
-array = "[" >> strip(elements) << "]"
+array = maybe_records @ ("[" >> strip(elements) << "]")
 
-pair = join([string << strip(":"), value])
+pair = join([(string @ shared_key) << strip(":"), value])
 pairs = pair.sep_by(strip(","))
 object_ = dict @ ("{" >> strip(pairs) << "}")
 
 json_options.extend([true, false, null, number, string, array, object_])
+compiled_value = value.compile()
 
 
-def loads(text: str) -> object:
+def loads(
+    text: str,
+    packrat: bool = False,
+    memo_size: int = 65536,
+    compiled: bool = False,
+    cache_keys: bool = False,
+    records: bool = False,
+) -> object:
     """
     Carrega um documento JSON e retorna o valor Python correspondente.
+    Aceita apenas str: para ler bytes, memoryview ou mmap sem decodificar o
+    documento inteiro, use loads() de json-oo.py.
+
+    Com packrat=True, memoiza o resultado de cada parser em cada posição
+    numa tabela limitada a memo_size entradas, criada para esta chamada. O
+    modo vem desligado porque a gramática JSON escolhe a alternativa pelo
+    primeiro caractere e nunca volta atrás: a tabela só acrescenta custo.
+    Ele compensa em gramáticas como "expr", abaixo (veja benchmark()).
+    Com compiled=True, usa a versão de "value" gerada por Parser.compile(),
+    que não consulta a tabela packrat: as duas opções não podem ser usadas
+    juntas.
+    Com cache_keys=True, chaves repetidas dos objetos passam a compartilhar
+    o mesmo objeto str. Com records=True, listas de objetos com as mesmas
+    chaves são retornadas como Records.
     """
+    if packrat and compiled:
+        raise ValueError("packrat não pode ser usado com compiled")
     st = (0, text)
-    return value.parse(st)[1]
+    token = loads_options.set(({} if cache_keys else None, records))
+    memo = Memo(memo_size) if packrat else None
+    try:
+        return (compiled_value if compiled else value).parse(st, memo)[1]
+    finally:
+        loads_options.reset(token)
 
 
 # Exemplos
@@ -244,7 +891,16 @@ assert loads("false") is False
 assert loads("null") is None
 
 assert loads("42") == 42
+assert loads("-1.5e3") == -1500.0
+assert loads(r'"tab\t\"quote\" \u00e9"') == 'tab\t"quote" é'
 assert loads('"Hello World"') == "Hello World"
+for bad in [r'"\x"', '"\\\n"', r'"\ud800"']:
+    try:
+        loads(bad)
+    except SyntaxError:
+        pass
+    else:
+        raise AssertionError(f"loads({bad!r}) deveria falhar")
 
 assert loads("[1,2,3]") == [1, 2, 3]
 assert loads("[[42]]") == [[42]]
@@ -260,3 +916,124 @@ assert loads('{"x":1, "y":2}') == {"x": 1, "y": 2}
 assert loads('{"x" : 1, "y" : 2}') == {"x": 1, "y": 2}
 assert loads('{ "x" : 1, "y" : 2 }') == {"x": 1, "y": 2}
 assert loads("{ }") == {}
+
+for packrat in (False, True):
+    try:
+        loads('{"x": [1, 2,, 3]}', packrat=packrat)
+    except SyntaxError as ex:
+        assert "at 12" in str(ex), ex
+    else:
+        raise AssertionError("loads() deveria falhar")
+
+assert loads('{"x": [1, {"y": []}]}', packrat=True) == {"x": [1, {"y": []}]}
+assert loads("[[1, 2], [3]]", packrat=True, memo_size=4) == [[1, 2], [3]]
+try:
+    loads("[]", packrat=True, compiled=True)
+except ValueError:
+    pass
+else:
+    raise AssertionError("packrat com compiled deveria falhar")
+
+# Gramática que volta atrás: as três alternativas de "expr" começam com
+# "term", que é lido de novo a cada tentativa. Sem packrat, o trabalho
+# triplica a cada nível de parênteses; com packrat, cresce linearmente.
+expr_options = []
+expr = anyof(expr_options)
+term = number | ("(" >> expr << ")")
+expr_options.extend([
+    join([term, "+" >> expr]) @ sum,
+    join([term, "-" >> expr]) @ (lambda xs: xs[0] - xs[1]),
+    term,
+])
+nested_expr = "(" * 6 + "1+(2-3)" + ")" * 6
+assert expr.parse((0, nested_expr))[1] == expr.parse((0, nested_expr), Memo())[1] == 0
+
+# A mesma mensagem de erro com e sem packrat, mesmo reaproveitando a tabela
+for src in ["((1+2)", "(1+)", "(1-(2+x))"]:
+    messages = []
+    shared_memo = Memo()
+    for memo in (None, shared_memo, shared_memo):
+        try:
+            expr.parse((0, src), memo)
+        except SyntaxError as ex:
+            messages.append(str(ex))
+    assert len(messages) == 3 and len(set(messages)) == 1, messages
+
+# Despacho pelo primeiro caractere funciona para qualquer alternativa com |
+digit_or_word = (number @ str) | literal("x", "xis") | (ws >> "!" >> literal("?", "?!"))
+assert digit_or_word.parse((0, "42"))[1] == "42"
+assert digit_or_word.parse((0, "x"))[1] == "xis"
+assert digit_or_word.parse((0, "  !?"))[1] == "?!"
+assert value.first() == (frozenset('tfn-0123456789"[{'), False)
+
+doc = '[{"x": 1, "y": 2}, {"x": 3, "y": 4}]'
+assert loads(doc, records=True) == Records(("x", "y"), [(1, 2), (3, 4)])
+assert loads(doc, records=True, compiled=True).dicts() == loads(doc)
+[a, b] = loads(doc, cache_keys=True)
+assert all(k1 is k2 for k1, k2 in zip(a, b))
+
+# Versão compilada retorna os mesmos valores e os mesmos erros
+doc = '{ "x" : [1, 2, {"y": [true, null]}], "z": "abc" }'
+assert loads(doc, compiled=True) == loads(doc)
+assert digit_or_word.compile().parse((0, "  !?"))[1] == "?!"
+
+# Sem backtracking dentro das folhas fundidas: o compilado falha onde o
+# interpretado falha
+sensitive = [
+    (ws >> literal(" x"), ["   x", " x", "x"]),
+    (number >> literal("1"), ["11", "1 1", "-11"]),
+    (number >> number >> literal("x"), ["12x", "1 2x", "0x"]),
+    (string << literal('"'), ['"a""', '"a"', '"a\\""']),
+    (number @ str << ws << literal(" ,"), ["10  ,", "10 ,", "10,"]),
+]
+for parser, inputs in sensitive:
+    compiled_parser = Compiler().compile(parser)
+    for src in inputs:
+        res = parser.run((0, src))
+        expected = FAIL if res is FAIL else (res[0][0], res[1])
+        assert compiled_parser(src, 0) == expected, (src, compiled_parser(src, 0), expected)
+
+
+def benchmark():
+    """
+    Mede o tempo por caractere em documentos cada vez mais aninhados, com e
+    sem o modo packrat. Um tempo por caractere constante indica que a leitura
+    é linear no tamanho da entrada. No JSON o packrat só custa; em "expr",
+    que volta atrás, ele evita o crescimento exponencial. Compara também
+    loads() interpretado e compilado.
+    """
+    from timeit import timeit
+
+    def nested(depth):
+        if depth == 0:
+            return '{"x": [1, 2, "a"], "y": null}'
+        inner = nested(depth - 1)
+        return f'[{inner}, {{"k": {inner}}}, 42]'
+
+    for depth in range(1, 8):
+        doc = nested(depth)
+        for packrat in (False, True):
+            n = 3
+            t = timeit(lambda: loads(doc, packrat=packrat), number=n) / n
+            us = 1e6 * t / len(doc)
+            print(f"depth={depth} size={len(doc):>7} packrat={packrat!s:<5} "
+                  f"{us:.3f} us/char")
+
+    # Aqui o packrat evita o trabalho exponencial
+    for depth in range(2, 10, 2):
+        src = "(" * depth + "1+2" + ")" * depth
+        for packrat in (False, True):
+            n = 3
+            t = timeit(lambda: expr.parse((0, src), Memo() if packrat else None), number=n) / n
+            print(f"expr depth={depth} packrat={packrat!s:<5} {1e3 * t:8.3f} ms")
+
+    doc = "[%s]" % ", ".join([nested(3)] * 20)
+    n = 5
+    t_interp = timeit(lambda: loads(doc), number=n) / n
+    t_compiled = timeit(lambda: loads(doc, compiled=True), number=n) / n
+    print(f"interpretado: {1e3 * t_interp:.2f} ms, compilado: "
+          f"{1e3 * t_compiled:.2f} ms ({t_interp / t_compiled:.1f}x)")
+
+
+if __name__ == "__main__":
+    benchmark()
@@ -0,0 +1,102 @@
+"""
+Base da otimização por dobra de constantes de lang.py e calc.py.
+
+ArithmeticFolder calcula antecipadamente as operações aritméticas entre nós
+"const" e remove identidades como x * 1 e x + 0. As subclasses de cada
+linguagem acrescentam os literais, nomes e funções da sua gramática.
+"""
+import operator
+from typing import Optional
+
+from lark import Token, Tree
+from lark.visitors import Transformer, v_args
+
+
+def is_const(node) -> bool:
+    return isinstance(node, Tree) and node.data == "const"
+
+
+def identity(node, value) -> bool:
+    # Só inteiros exatos: x * 1.0 é float mesmo quando x é int
+    return is_const(node) and type(node.children[0]) is int and node.children[0] == value
+
+
+def make_fold_binop(name, fn):
+    def fold_binop(self, x, y):
+        return self.fold(name, fn, x, y)
+    return fold_binop
+
+
+@v_args(inline=True)
+class ArithmeticFolder(Transformer):
+    """
+    Substitui por nós "const" as operações aritméticas entre constantes e
+    elimina identidades como x * 1 e x + 0.
+
+    As identidades só são aplicadas quando se sabe que x é um número: com
+    x = True, x * 1 vale 1, e com x = "a", x + 0 falha. Operações que falham,
+    como 3 / 0, não são calculadas aqui: o erro continua acontecendo apenas
+    se a expressão for avaliada.
+    """
+    add = make_fold_binop("add", operator.add)
+    sub = make_fold_binop("sub", operator.sub)
+    mul = make_fold_binop("mul", operator.mul)
+    div = make_fold_binop("div", operator.truediv)
+    pow = make_fold_binop("pow", operator.pow)
+
+    def neg(self, x):
+        return self.fold("neg", operator.neg, x)
+
+    def pos(self, x):
+        return self.fold("pos", operator.pos, x)
+
+    def fold(self, name, fn, *args):
+        if all(map(is_const, args)):
+            try:
+                return Tree("const", [fn(*(arg.children[0] for arg in args))])
+            except Exception:
+                pass
+        return self.simplify(name, *args)
+
+    def simplify(self, name, *args):
+        # x + 0 não vale para floats: -0.0 + 0 == 0.0
+        if name in ("add", "sub") and identity(args[-1], 0):
+            kinds = (int,) if name == "add" else (int, float)
+            if self.number_type(args[0]) in kinds:
+                return args[0]
+        if name == "add" and identity(args[0], 0) and self.number_type(args[1]) is int:
+            return args[1]
+        if name in ("mul", "pow") and identity(args[-1], 1):
+            if self.number_type(args[0]) in (int, float):
+                return args[0]
+        if name == "mul" and identity(args[0], 1) and self.number_type(args[1]) in (int, float):
+            return args[1]
+        return Tree(name, list(args))
+
+    def number_type(self, node) -> Optional[type]:
+        """
+        Retorna int, float ou complex quando o valor do nó certamente tem esse
+        tipo, ou None quando não se sabe (variáveis, bool, etc.).
+        """
+        if not isinstance(node, Tree):
+            return None
+        if node.data == "const":
+            kind = type(node.children[0])
+            return kind if kind in (int, float, complex) else None
+        if node.data in ("neg", "pos"):
+            return self.number_type(node.children[0])
+        if node.data in ("add", "sub", "mul", "div"):
+            kinds = {self.number_type(child) for child in node.children}
+            if None in kinds:
+                return None
+            if complex in kinds:
+                return complex
+            return int if kinds == {int} and node.data != "div" else float
+        return None
+
+
+def tree_size(node) -> int:
+    # Tokens contam como nós; os valores guardados em "const", não
+    if isinstance(node, Tree):
+        return 1 + sum(map(tree_size, node.children))
+    return isinstance(node, Token)
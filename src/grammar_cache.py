@@ -0,0 +1,183 @@
+"""
+Carrega parsers do Lark guardando em disco as tabelas já construídas.
+
+Construir um Lark(...) envolve analisar o texto da gramática e montar as
+tabelas LALR, o que cada processo paga ao importar o módulo. load_parser()
+faz isso apenas na primeira vez e salva o resultado num arquivo cujo nome é
+o hash da gramática e das opções. As próximas chamadas, mesmo em outros
+processos, apenas leem o arquivo.
+
+Invalidação: a chave inclui o texto da gramática, as opções de construção,
+a versão do lark e a versão do Python. Qualquer mudança em um deles gera
+uma chave nova e o arquivo antigo simplesmente deixa de ser usado, como
+acontece com os .pyc em __pycache__. Arquivos que não correspondem ao hash
+são reconstruídos. clear_cache() apaga tudo.
+
+O diretório padrão é __pycache__/lark, ao lado deste arquivo, e pode ser
+trocado pela variável de ambiente GRAMMAR_CACHE_DIR.
+
+O lark só sabe serializar parsers LALR; com parser="earley" a gramática é
+construída normalmente, sem cache.
+
+Já cached_parse() guarda na memória as árvores de fontes repetidos.
+"""
+import ast
+import hashlib
+import os
+import sys
+import time
+from functools import lru_cache
+from pathlib import Path
+
+import lark
+
+CACHE_DIR = Path(
+    os.environ.get("GRAMMAR_CACHE_DIR", Path(__file__).parent / "__pycache__" / "lark")
+)
+
+# Opções que não mudam as tabelas e por isso ficam fora da chave
+RUNTIME_OPTIONS = {"transformer", "postlex", "lexer_callbacks", "tree_class"}
+
+
+def cache_key(grammar: str, options: dict) -> str:
+    """
+    Hash que identifica as tabelas geradas para a gramática e as opções.
+    """
+    build_options = sorted(
+        (k, repr(v)) for k, v in options.items() if k not in RUNTIME_OPTIONS
+    )
+    data = repr((grammar, build_options, lark.__version__, sys.version_info[:2]))
+    return hashlib.sha256(data.encode("utf8")).hexdigest()
+
+
+def cache_path(grammar: str, **options) -> Path:
+    """
+    Arquivo onde fica guardado o parser para a gramática e as opções.
+    """
+    return CACHE_DIR / f"{cache_key(grammar, options)}.lark"
+
+
+def load_parser(grammar: str, **options) -> lark.Lark:
+    """
+    Equivalente a lark.Lark(grammar, **options), mas reutiliza o parser
+    salvo em disco quando a gramática e as opções já foram vistas antes.
+    """
+    if options.get("parser", "earley") != "lalr":
+        return lark.Lark(grammar, **options)
+
+    path = cache_path(grammar, **options)
+    if not path.exists():
+        try:
+            build_parser(grammar, path, options)
+        except OSError:
+            # Sem permissão de escrita, o cache apenas não é usado
+            return lark.Lark(grammar, **options)
+
+    # O próprio lark confere o hash gravado no arquivo e reconstrói as
+    # tabelas se ele não corresponder à gramática
+    return lark.Lark(grammar, cache=str(path), **options)
+
+
+# Número de árvores guardadas por cached_parse()
+PARSE_CACHE_SIZE = 1024
+
+
+def cached_parse(parse, maxsize: int = PARSE_CACHE_SIZE):
+    """
+    Envolve a função "parse" num cache LRU (seguro entre threads) com até
+    "maxsize" resultados, de modo que fontes repetidos não sejam analisados
+    de novo. cache_info() da função retornada mostra os acertos e as falhas.
+
+    Para trocar o tamanho, basta envolver "parse" de novo: o cache antigo é
+    descartado junto com a função anterior.
+    """
+    return lru_cache(maxsize)(parse)
+
+
+def build_parser(grammar: str, path: Path, options: dict):
+    """
+    Constrói as tabelas num arquivo temporário e depois o renomeia, de modo
+    que processos concorrentes nunca leem um arquivo pela metade.
+    """
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    lark.Lark(grammar, cache=str(tmp), **options)
+    os.replace(tmp, path)
+
+
+def clear_cache() -> int:
+    """
+    Apaga todos os parsers salvos e retorna quantos arquivos foram removidos.
+    """
+    removed = 0
+    for path in CACHE_DIR.glob("*.lark"):
+        path.unlink(missing_ok=True)
+        removed += 1
+    return removed
+
+
+def module_grammars(filename):
+    """
+    Extrai as chamadas load_parser(...) de um script sem executá-lo, desde
+    que a gramática seja uma string literal ou uma variável global definida
+    com uma. Retorna pares (gramática, opções).
+    """
+    tree = ast.parse(Path(filename).read_text())
+    constants = {
+        target.id: node.value
+        for node in tree.body
+        if isinstance(node, ast.Assign) and isinstance(node.value, ast.Constant)
+        for target in node.targets
+        if isinstance(target, ast.Name)
+    }
+    for node in ast.walk(tree):
+        if (
+            isinstance(node, ast.Call)
+            and node.args
+            and getattr(node.func, "id", None) == "load_parser"
+        ):
+            grammar = node.args[0]
+            grammar = constants.get(getattr(grammar, "id", None), grammar)
+            if not isinstance(grammar, ast.Constant):
+                continue
+            options = {}
+            for kw in node.keywords:
+                try:
+                    options[kw.arg] = ast.literal_eval(kw.value)
+                except ValueError:
+                    pass  # transformer e outros objetos não alteram as tabelas
+            yield grammar.value, options
+
+
+def benchmark():
+    """
+    Compara o tempo de construir cada gramática do diretório com o tempo de
+    carregá-la do cache.
+    """
+    tmp = CACHE_DIR / "benchmark.lark"
+    print(f"{'módulo':<18} {'construção':>12} {'cache':>10} {'ganho':>8}")
+    for filename in sorted(Path(__file__).parent.glob("*.py")):
+        if filename.name == Path(__file__).name:
+            continue
+        for grammar, options in module_grammars(filename):
+            build = load_time(lambda: build_parser(grammar, tmp, options))
+            load_parser(grammar, **options)
+            cached = load_time(lambda: load_parser(grammar, **options))
+            print(
+                f"{filename.name:<18} {build * 1000:10.2f}ms {cached * 1000:8.2f}ms "
+                f"{build / cached:7.1f}x"
+            )
+    tmp.unlink(missing_ok=True)
+
+
+def load_time(func, repeat=5):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+if __name__ == "__main__":
+    benchmark()
@@ -0,0 +1,153 @@
+"""
+Compara a vazão e o uso de memória das implementações de loads() deste
+diretório, usando o módulo json da biblioteca padrão como referência.
+
+Uso: python json-benchmark.py [tamanho do documento em KB]
+
+Cada medida roda num processo separado, de modo que o pico de memória
+residente (RSS) reportado corresponde a um único parser lendo um único
+documento.
+"""
+import contextlib
+import importlib.util
+import io
+import json
+import random
+import resource
+import sys
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from pathlib import Path
+
+DIRECTORY = Path(__file__).parent
+
+# (nome, arquivo, opções de loads, entrada em bytes?)
+PARSERS = [
+    ("json (stdlib)", None, {}, False),
+    ("json-reader", "json-reader.py", {}, False),
+    ("json-oo", "json-oo.py", {}, False),
+    ("json-oo (bytes)", "json-oo.py", {}, True),
+    ("json-combinators", "json-combinators.py", {}, False),
+    ("combinators-lib", "combinators-lib.py", {}, False),
+    ("combinators-lib (compiled)", "combinators-lib.py", {"compiled": True}, False),
+    ("combinators-lib (packrat)", "combinators-lib.py", {"packrat": True}, False),
+    ("json-grammar", "json-grammar.py", {}, False),
+    ("json-grammar (lalr)", "json-grammar.py", {"fast": True}, False),
+    ("json-exato", "json-exato.py", {}, False),
+    ("json-exato (lalr)", "json-exato.py", {"fast": True}, False),
+    ("json-lex (tokens)", "json-lex.py", {}, False),
+]
+
+
+def load_module(filename):
+    """
+    Importa um dos scripts do diretório, apesar do hífen no nome, sem
+    mostrar o que ele imprime ao rodar os exemplos.
+    """
+    name = filename[:-3].replace("-", "_")
+    spec = importlib.util.spec_from_file_location(name, DIRECTORY / filename)
+    module = importlib.util.module_from_spec(spec)
+    with contextlib.redirect_stdout(io.StringIO()):
+        spec.loader.exec_module(module)
+    return module
+
+
+def make_corpus(size):
+    """
+    Gera documentos de aproximadamente "size" bytes. Usa apenas inteiros
+    não negativos, strings ASCII sem escapes e nenhum espaço em branco, que
+    é o subconjunto de JSON aceito por todas as implementações.
+    """
+    rnd = random.Random(42)
+
+    def word():
+        return "".join(rnd.choice("abcdefghij") for _ in range(rnd.randint(3, 10)))
+
+    def fill(make):
+        items, total = [], 2
+        while total < size:
+            item = make()
+            items.append(item)
+            total += len(json.dumps(item, separators=(",", ":"))) + 1
+        return items
+
+    def nested(depth):
+        if depth == 0:
+            return [rnd.randint(0, 1000), word(), None]
+        return {"level": depth, "child": nested(depth - 1), "tags": [word(), True]}
+
+    def deep():
+        return nested(30)
+
+    documents = {
+        "flat array": fill(lambda: rnd.choice([rnd.randint(0, 10**6), word(), True, None])),
+        "deep nesting": fill(deep),
+        "long strings": fill(lambda: word() * 200),
+        "small objects": fill(lambda: {"id": rnd.randint(0, 10**6), "name": word()}),
+        "numbers": fill(lambda: rnd.randint(0, 10**12)),
+    }
+    return {
+        name: json.dumps(doc, separators=(",", ":"))
+        for name, doc in documents.items()
+    }
+
+
+def measure(parser, corpus_name, size):
+    """
+    Mede um parser lendo um documento do corpus. Roda no processo filho.
+    """
+    name, filename, options, as_bytes = parser
+    sys.setrecursionlimit(10_000)
+    text = make_corpus(size)[corpus_name]
+    try:
+        loads = json.loads if filename is None else load_module(filename).loads
+    except ImportError as ex:
+        return f"n/a ({ex.name} não instalado)"
+
+    data = text.encode() if as_bytes else text
+    expected = json.loads(text)
+    try:
+        if loads(data, **options) != expected:
+            return "n/a (resultado incorreto)"
+    except Exception as ex:
+        # Qualquer erro de uma implementação vira uma linha "n/a", sem
+        # interromper as outras medidas
+        return f"n/a ({type(ex).__name__})"
+
+    runs, elapsed = 0, 0.0
+    while elapsed < 0.5 and runs < 1000:
+        start = time.perf_counter()
+        loads(data, **options)
+        elapsed += time.perf_counter() - start
+        runs += 1
+
+    tracemalloc.start()
+    loads(data, **options)
+    _, traced_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss  # KB no Linux
+    mb_per_s = len(text.encode()) / (elapsed / runs) / 1e6
+    return f"{mb_per_s:9.2f} MB/s {traced_peak / 1024:10.0f} KB {rss / 1024:8.1f} MB"
+
+
+def main(size):
+    print(f"Documentos de ~{size // 1024} KB; colunas: vazão, pico de memória "
+          f"alocada ao mesmo tempo (tracemalloc), pico de RSS do processo")
+    context = get_context("spawn")
+    for corpus_name in make_corpus(size):
+        print(f"\n{corpus_name}")
+        for parser in PARSERS:
+            # Um processo novo por medida, para isolar o RSS
+            with ProcessPoolExecutor(1, mp_context=context) as pool:
+                try:
+                    result = pool.submit(measure, parser, corpus_name, size).result()
+                except Exception as ex:
+                    result = f"n/a ({type(ex).__name__})"
+            print(f"  {parser[0]:<28} {result}")
+
+
+if __name__ == "__main__":
+    main(1024 * int(sys.argv[1]) if len(sys.argv) > 1 else 32 * 1024)
@@ -1,11 +1,43 @@
-from typing import Tuple, Callable, Any, List
+from contextvars import ContextVar
+from typing import Tuple, Callable, Any, List, Optional
+
+from json_common import cache_key, compact
 
 ST = Tuple[int, str]
-Parser = Callable[[ST], Tuple[ST, Any]]
+Result = Optional[Tuple[ST, Any]]
+Parser = Callable[[ST], Result]
+
+# Sentinela retornado por um parser que falhou. Nenhuma exceção é criada
+# enquanto as alternativas são testadas.
+FAIL: Any = None
+
+# Posição mais distante onde algum parser falhou e o que era esperado ali,
+# numa lista [pos, expected] própria de cada chamada a loads()
+failure: ContextVar[list] = ContextVar("failure")
 
 
-def error(st, msg):
-    return SyntaxError(msg)
+def fail(st: ST, expected: str) -> Result:
+    """
+    Registra que "expected" era esperado no estado "st" e retorna FAIL.
+    """
+    record = failure.get()
+    pos = st[0]
+    if pos > record[0]:
+        record[0] = pos
+        record[1] = []
+    if pos == record[0]:
+        record[1].append(expected)
+    return FAIL
+
+
+def error(st: ST) -> SyntaxError:
+    """
+    Cria um SyntaxError descrevendo a falha mais distante registrada.
+    """
+    failure_pos, failure_expected = failure.get()
+    pos, src = max(failure_pos, st[0]), st[1]
+    expected = " or ".join(dict.fromkeys(failure_expected)) or "valid input"
+    return SyntaxError(f"expect {expected} at {pos}, got {src[pos:pos + 10]!r}")
 
 
 def literal(lit: str, value=None) -> Parser:
@@ -13,14 +45,16 @@ def literal(lit: str, value=None) -> Parser:
     Lê um valor literal "lit" e retorna "value" se bem sucedido
     """
 
-    def parser(st: ST) -> Tuple[ST, Any]:
+    expected = repr(lit)
+
+    def parser(st: ST) -> Result:
         pos, src = st
 
         if src.startswith(lit, pos):
             st = (pos + len(lit), src)
             return st, value
         else:
-            raise error(st, f"expect {lit!r}!")
+            return fail(st, expected)
 
     return parser
 
@@ -31,14 +65,12 @@ def anyof(parsers: List[Parser]) -> Parser:
     sucedido.
     """
 
-    def parser(st: ST) -> Tuple[ST, Any]:
+    def parser(st: ST) -> Result:
         for parser in parsers:
-            try:
-                return parser(st)
-            except SyntaxError:
-                continue
-
-        raise error(st, "all parsers failed")
+            res = parser(st)
+            if res is not FAIL:
+                return res
+        return FAIL
 
     return parser
 
@@ -48,10 +80,11 @@ def seq(p1: Parser, p2: Parser) -> Parser:
     Executa dois parsers e retorna o resultado do segundo.
     """
 
-    def parser(st: ST) -> Tuple[ST, Any]:
-        st, __ = p1(st)
-        st, v2 = p2(st)
-        return st, v2
+    def parser(st: ST) -> Result:
+        res = p1(st)
+        if res is FAIL:
+            return FAIL
+        return p2(res[0])
 
     return parser
 
@@ -61,10 +94,15 @@ def rseq(p1: Parser, p2: Parser) -> Parser:
     Executa dois parsers e retorna o resultado do primeiro.
     """
 
-    def parser(st: ST) -> Tuple[ST, Any]:
-        st, v1 = p1(st)
-        st, __ = p2(st)
-        return st, v1
+    def parser(st: ST) -> Result:
+        res = p1(st)
+        if res is FAIL:
+            return FAIL
+        st, v1 = res
+        res = p2(st)
+        if res is FAIL:
+            return FAIL
+        return res[0], v1
 
     return parser
 
@@ -74,20 +112,22 @@ def sep_by(sep: Parser, elem: Parser) -> Parser:
     Lê lista com zero ou mais "elem"s separados por "sep".
     """
 
-    def parser(st: ST) -> Tuple[ST, list]:
-        try:
-            st, x = elem(st)
-        except SyntaxError:
+    def parser(st: ST) -> Result:
+        res = elem(st)
+        if res is FAIL:
             return st, []
 
+        st, x = res
         elems = [x]
         while True:
-            try:
-                st, _ = sep(st)
-            except SyntaxError:
+            res = sep(st)
+            if res is FAIL:
                 return st, elems
 
-            st, x = elem(st)
+            res = elem(res[0])
+            if res is FAIL:
+                return FAIL
+            st, x = res
             elems.append(x)
 
     return parser
@@ -98,10 +138,13 @@ def join(parsers: List[Parser]) -> Parser:
     Executa todos parsers agregando o resultado em uma lista.
     """
 
-    def parser(st: ST) -> Tuple[ST, list]:
+    def parser(st: ST) -> Result:
         results = []
         for parser in parsers:
-            st, x = parser(st)
+            res = parser(st)
+            if res is FAIL:
+                return FAIL
+            st, x = res
             results.append(x)
         return st, results
 
@@ -113,14 +156,16 @@ def map(fn, parser: Parser) -> Parser:
     Aplica a função no resultado obtido pelo parser.
     """
     
-    def parser_(st: ST) -> Tuple[ST, list]:
-        st, x = parser(st)
-        return st, fn(x)
+    def parser_(st: ST) -> Result:
+        res = parser(st)
+        if res is FAIL:
+            return FAIL
+        return res[0], fn(res[1])
 
     return parser_
 
 
-def number(st: ST) -> Tuple[ST, int]:
+def number(st: ST) -> Result:
     """
     Lê um número.
     """
@@ -129,23 +174,35 @@ def number(st: ST) -> Tuple[ST, int]:
     while pos_end < len(src) and src[pos_end].isdigit():
         pos_end += 1
     if pos == pos_end:
-        raise error(st, "not a number")
+        return fail(st, "number")
     n = int(src[pos:pos_end])
     return (pos_end, src), n
 
 
-def string(st: ST) -> Tuple[ST, str]:
+def string(st: ST) -> Result:
     """
     Lê uma string.
     """
     pos, src = st
-    if src[pos] != '"':
-        raise error(st, "not a string!")
+    if not src.startswith('"', pos):
+        return fail(st, "string")
     pos_end = src.find('"', pos + 1)
     string = src[pos + 1 : pos_end]
     return (pos_end + 1, src), string
 
 
+# Opções (key_cache, records) da chamada a loads() em andamento
+loads_options: ContextVar[tuple] = ContextVar("loads_options", default=(None, False))
+
+
+def shared_key(key: str) -> str:
+    return cache_key(loads_options.get()[0], key)
+
+
+def maybe_records(elements: list):
+    return compact(elements) if loads_options.get()[1] else elements
+
+
 json_options = []
 value = anyof(json_options)
 true = literal("true", True)
@@ -153,21 +210,34 @@ false = literal("false", False)
 null = literal("null", None)
 
 elements = sep_by(literal(","), value)
-array = rseq(seq(literal("["), elements), literal("]"))
+array = map(maybe_records, rseq(seq(literal("["), elements), literal("]")))
 
-pair = join([rseq(string, literal(":")), value])
+pair = join([rseq(map(shared_key, string), literal(":")), value])
 pairs = sep_by(literal(","), pair)
 object_ = map(dict, rseq(seq(literal("{"), pairs), literal("}")))
 
 json_options.extend([true, false, null, number, string, array, object_])
 
 
-def loads(text: str) -> object:
+def loads(text: str, cache_keys: bool = False, records: bool = False) -> object:
     """
     Carrega um documento JSON e retorna o valor Python correspondente.
+
+    Com cache_keys=True, chaves repetidas dos objetos passam a compartilhar
+    o mesmo objeto str. Com records=True, listas de objetos com as mesmas
+    chaves são retornadas como Records.
     """
+    token = failure.set([-1, []])
+    options_token = loads_options.set(({} if cache_keys else None, records))
     st = (0, text)
-    return value(st)[1]
+    try:
+        res = value(st)
+        if res is FAIL:
+            raise error(st)
+    finally:
+        loads_options.reset(options_token)
+        failure.reset(token)
+    return res[1]
 
 
 # Exemplos
@@ -178,3 +248,4 @@ print(loads("42"))
 print(loads('"Hello World"'))
 print(loads("[true,false,null,[1,2,3,[]]]"))
 print(loads('{"answer":[1,2,[]]}'))
+print(loads('[{"x":1,"y":2},{"x":3,"y":4}]', cache_keys=True, records=True))
@@ -1,4 +1,7 @@
 import lark
+from contextvars import ContextVar
+from grammar_cache import load_parser
+from json_common import cache_key, compact
 from lark.visitors import Transformer  # pip3 install lark-parser
 
 # EBNF
@@ -24,6 +27,11 @@ pair   : STRING ":" value
 
 
 class JSONTransformer(lark.Transformer):
+    def __init__(self, cache_keys=False, records=False):
+        super().__init__()
+        self.key_cache = {} if cache_keys else None
+        self.records = records
+
     def null(self, children):
         return None
 
@@ -40,26 +48,64 @@ class JSONTransformer(lark.Transformer):
         return st[1:-1]
 
     def array(self, children):
-        return children
+        return compact(children) if self.records else children
 
     def object(self, children):
         return dict(children)
 
     def pair(self, children):
-        return tuple(children)
+        key, value = children
+        return cache_key(self.key_cache, key), value
 
     def start(self, children):
         return children[0]
 
 parser = lark.Lark(grammar)
 
+# Opções (key_cache, records) da chamada a loads(fast=True) em andamento. O
+# parser é compartilhado entre as threads; as opções, não.
+fast_options: ContextVar[tuple] = ContextVar("fast_options", default=(None, False))
+
+
+class FastJSONTransformer(JSONTransformer):
+    """
+    JSONTransformer de fast_parser: array() e pair() leem as opções de
+    fast_options.
+    """
+
+    def array(self, children):
+        return compact(children) if fast_options.get()[1] else children
+
+    def pair(self, children):
+        key, value = children
+        return cache_key(fast_options.get()[0], key), value
+
+
+# A gramática é LALR(1): no modo rápido, o transformer é aplicado durante a
+# análise e nenhuma árvore intermediária é construída.
+fast_parser = load_parser(grammar, parser="lalr", transformer=FastJSONTransformer())
 
-def loads(text: str) -> object:
+
+def loads(
+    text: str, cache_keys: bool = False, records: bool = False, fast: bool = False
+) -> object:
     """
     Carrega um documento JSON e retorna o valor Python correspondente.
+
+    Com cache_keys=True, chaves repetidas dos objetos passam a compartilhar
+    o mesmo objeto str. Com records=True, listas de objetos com as mesmas
+    chaves são retornadas como Records. Com fast=True, usa o parser LALR
+    no lugar do Earley.
     """
+    if fast:
+        token = fast_options.set(({} if cache_keys else None, records))
+        try:
+            return fast_parser.parse(text)
+        finally:
+            fast_options.reset(token)
+
     tree = parser.parse(text)
-    transformer = JSONTransformer()
+    transformer = JSONTransformer(cache_keys, records)
     tree = transformer.transform(tree)
     if hasattr(tree, "pretty"):
         return tree.pretty()
@@ -74,3 +120,4 @@ print(loads("42"))
 print(loads('"Hello World"'))
 print(loads("[true,false,null,[1,2,3,[]]]"))
 print(loads('{"answer":[1,2,[]]}'))
+print(loads('[{"x":1,"y":2},{"x":3,"y":4}]', cache_keys=True, records=True))
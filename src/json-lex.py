@@ -1,41 +1,443 @@
+from array import array
+from concurrent.futures import ProcessPoolExecutor
 from pprint import pprint
 from typing import NamedTuple
+import mmap
+import os
 import re
 
+from json_common import unescape
+
 
 class Token(NamedTuple):
     type: str
     value: str
-    
+    line: int = 0
+    column: int = 0
+
+
+class LexError(SystemError):
+    """
+    Trecho que não inicia nenhum token, com sua posição no texto e a linha e
+    a coluna correspondentes, contadas a partir de 1.
+    """
+
+    def __init__(self, message: str, pos: int, line: int, column: int):
+        super().__init__(f"{message} na linha {line}, coluna {column}")
+        self.message = message
+        self.pos = pos
+        self.line = line
+        self.column = column
+
+    def __reduce__(self):
+        return LexError, (self.message, self.pos, self.line, self.column)
+
 
 LEX_SPECIFICATION = {
-    "STRING": r'"( |!|[#-[]|[\]-\U0010FFFF]|\\(["\\\/bfnrt]|u[0-9a-zA-Z]{4}))*"',
-    "NUMBER": r'-?(0|[1-9][0-9]*)(\.[0-9]+)?([eE][+-][0-9]+)?',
-    "LIT": r'true|false|null',          
+    "STRING": r'"( |!|[#-[]|[\]-\U0010FFFF]|\\(["\\\/bfnrt]|u[0-9a-fA-F]{4}))*"',
+    "NUMBER": r'-?(0|[1-9][0-9]*)(\.[0-9]+)?([eE][+-]?[0-9]+)?',
+    "LIT": r'true|false|null',
     "OP": r'[{}[\],:]',
     "WS": r'\s+',
-    "ERROR": r'.',          
+    "ERROR": r'.',
 }
 PATTERN = '|'.join('(?P<%s>%s)' % pair for pair in LEX_SPECIFICATION.items())
-REGEX = re.compile(PATTERN)    
+REGEX = re.compile(PATTERN)
+
+
+def decode_number(text: str):
+    """
+    Converte o texto de um NUMBER em int ou float, sem eval().
+    """
+    if "." in text or "e" in text or "E" in text:
+        return float(text)
+    return int(text)
+
+
+def decode_string(text: str) -> str:
+    """
+    Converte o texto de um STRING, incluindo as aspas, em str, sem eval().
+    """
+    st = text[1:-1]
+    if "\\" in st:
+        st = unescape(st)
+    return st
+
+
+# Após um erro, a análise recomeça no próximo token estrutural ou na
+# próxima linha
+SYNC_SEARCH = re.compile(r'[{}[\],:\n]').search
+
+
+def resync(src: str, pos: int) -> int:
+    mo = SYNC_SEARCH(src, pos + 1)
+    return len(src) if mo is None else mo.start()
+
+
+def tokenize(src, errors: list = None):
+    """
+    Gera os tokens do texto com a linha e a coluna de cada um. A linha é
+    atualizada contando as quebras de linha dos espaços em branco, sem
+    reler o início do texto.
+
+    Um caractere inválido levanta LexError. Se errors for uma lista, o erro
+    é anotado nela e a análise continua no próximo token estrutural.
+    """
+    pos, size = 0, len(src)
+    line, line_start = 1, 0
+    while pos < size:
+        # Depois de um erro, a busca recomeça no ponto de sincronização
+        for mo in REGEX.finditer(src, pos):
+            kind = mo.lastgroup
+            value = mo.group()
+            if kind == 'WS':
+                newlines = value.count("\n")
+                if newlines:
+                    line += newlines
+                    line_start = mo.start() + value.rindex("\n") + 1
+                continue
+
+            column = mo.start() - line_start + 1
+            if kind == 'ERROR':
+                error = LexError(f"caractere inválido {value!r}", mo.start(), line, column)
+                if errors is None:
+                    raise error
+                errors.append(error)
+                pos = resync(src, mo.start())
+                break
+            if kind == 'NUMBER':
+                value = decode_number(value)
+            elif kind == 'STRING':
+                value = decode_string(value)
+
+            yield Token(kind, value, line, column)
+        else:
+            return
 
 
-def tokenize(src):
-    for mo in REGEX.finditer(src):
-        kind = mo.lastgroup
-        value = mo.group()
-        if kind in ('NUMBER', 'STRING'):
-            value = eval(value)
-        elif kind == 'WS':
+def lex(src: str, errors: list = None) -> list:
+    return list(tokenize(src, errors))
+
+
+#
+# Modo em lote: em vez de um Token por lexema, lex_array() devolve arrays
+# paralelos com o tipo de cada token e as posições de início e fim no texto.
+# Os valores só são decodificados quando pedidos, com Tokens.value(i).
+#
+STRING, NUMBER, TRUE, FALSE, NULL, LBRACE, RBRACE, LBRACKET, RBRACKET, COMMA, COLON = range(11)
+KIND_NAMES = [
+    "STRING", "NUMBER", "TRUE", "FALSE", "NULL", "{", "}", "[", "]", ",", ":",
+]
+WS, ERROR = 254, 255
+
+# Tabela indexada pelo primeiro caractere do token
+KIND_TABLE = bytearray([ERROR]) * 128
+for char, kind in {
+    '"': STRING, "t": TRUE, "f": FALSE, "n": NULL, "{": LBRACE, "}": RBRACE,
+    "[": LBRACKET, "]": RBRACKET, ",": COMMA, ":": COLON,
+    " ": WS, "\t": WS, "\n": WS, "\r": WS, "\x0b": WS, "\x0c": WS,
+}.items():
+    KIND_TABLE[ord(char)] = kind
+for char in "-0123456789":
+    KIND_TABLE[ord(char)] = NUMBER
+
+LITERALS = {TRUE: True, FALSE: False, NULL: None}
+LITERAL_TEXT = {TRUE: "true", FALSE: "false", NULL: "null"}
+
+STRING_MATCH = re.compile(r'"([^"\\\x00-\x1f]|\\(["\\/bfnrt]|u[0-9a-fA-F]{4}))*"').match
+NUMBER_MATCH = re.compile(LEX_SPECIFICATION["NUMBER"]).match
+WS_MATCH = re.compile(LEX_SPECIFICATION["WS"]).match
+
+
+class Tokens(NamedTuple):
+    src: str
+    kinds: array
+    starts: array
+    ends: array
+
+    def __len__(self):
+        return len(self.kinds)
+
+    def text(self, i: int) -> str:
+        return self.src[self.starts[i]:self.ends[i]]
+
+    def value(self, i: int):
+        """
+        Decodifica o valor do i-ésimo token.
+        """
+        kind = self.kinds[i]
+        if kind == STRING:
+            return decode_string(self.text(i))
+        if kind == NUMBER:
+            return decode_number(self.text(i))
+        if kind in LITERALS:
+            return LITERALS[kind]
+        return KIND_NAMES[kind]
+
+
+def lex_array(src: str, errors: list = None) -> Tokens:
+    """
+    Separa todos os tokens do documento de uma vez. O primeiro caractere
+    decide, pela tabela KIND_TABLE, o tipo do token; apenas strings,
+    números e espaços precisam de uma expressão regular para achar o fim.
+
+    Os erros são tratados como em tokenize(): LexError, ou, se errors for
+    uma lista, o erro anotado nela e nenhum token para o trecho inválido.
+    Como os arrays guardam apenas posições, a linha só é calculada nos
+    erros, contando as quebras de linha desde o erro anterior.
+    """
+    kinds = array("B")
+    starts = array("I")
+    ends = array("I")
+    add_kind, add_start, add_end = kinds.append, starts.append, ends.append
+    table = KIND_TABLE
+    pos, size = 0, len(src)
+    # Linha e início da linha, contados até a posição do último erro
+    line, line_start, counted = 1, 0, 0
+
+    while pos < size:
+        char = ord(src[pos])
+        kind = table[char] if char < 128 else ERROR
+        if kind >= LBRACE:
+            if kind == WS:
+                pos = WS_MATCH(src, pos).end()
+                continue
+            end = None if kind == ERROR else pos + 1
+        elif kind == STRING or kind == NUMBER:
+            mo = (STRING_MATCH if kind == STRING else NUMBER_MATCH)(src, pos)
+            end = None if mo is None else mo.end()
+        else:
+            literal = LITERAL_TEXT[kind]
+            end = pos + len(literal) if src.startswith(literal, pos) else None
+
+        if end is None:
+            sync = resync(src, pos)
+            if kind == ERROR:
+                message = f"caractere inválido {src[pos]!r}"
+            else:
+                message = f"token inválido {src[pos:min(sync, pos + 20)]!r}"
+            newlines = src.count("\n", counted, pos)
+            if newlines:
+                line += newlines
+                line_start = src.rindex("\n", counted, pos) + 1
+            counted = pos
+            error = LexError(message, pos, line, pos - line_start + 1)
+            if errors is None:
+                raise error
+            errors.append(error)
+            pos = sync
             continue
-        elif kind == 'ERROR':
-            raise SystemError(mo)
-        
-        yield Token(kind, value)
+        add_kind(kind)
+        add_start(pos)
+        add_end(end)
+        pos = end
+
+    return Tokens(src, kinds, starts, ends)
+
 
+def parse_tokens(tokens: Tokens, many: bool = False):
+    """
+    Analisa o documento a partir dos arrays de lex_array(), sem criar um
+    objeto por token. Com many=True aceita vários documentos seguidos, como
+    num arquivo NDJSON, e retorna a lista deles.
+    """
+    kinds, starts, ends, src = tokens.kinds, tokens.starts, tokens.ends, tokens.src
+    size = len(kinds)
 
-def lex(src: str) -> list:
-    return list(tokenize(src))
+    def expect(i, kind):
+        if i >= size:
+            raise SyntaxError(f"esperava {KIND_NAMES[kind]!r}, mas o documento terminou")
+        if kinds[i] != kind:
+            raise SyntaxError(f"esperava {KIND_NAMES[kind]!r} em {starts[i]}, obteve {tokens.text(i)!r}")
+
+    def value(i):
+        if i >= size:
+            raise SyntaxError("documento terminou antes do esperado")
+        kind = kinds[i]
+        if kind == STRING:
+            text = src[starts[i] + 1:ends[i] - 1]
+            if "\\" in text:
+                return decode_string(src[starts[i]:ends[i]]), i + 1
+            return text, i + 1
+        if kind == NUMBER:
+            return decode_number(src[starts[i]:ends[i]]), i + 1
+        if kind == LBRACKET:
+            result = []
+            i += 1
+            if i < size and kinds[i] == RBRACKET:
+                return result, i + 1
+            while True:
+                item, i = value(i)
+                result.append(item)
+                if i < size and kinds[i] == COMMA:
+                    i += 1
+                    continue
+                expect(i, RBRACKET)
+                return result, i + 1
+        if kind == LBRACE:
+            result = {}
+            i += 1
+            if i < size and kinds[i] == RBRACE:
+                return result, i + 1
+            while True:
+                expect(i, STRING)
+                key, i = value(i)
+                expect(i, COLON)
+                result[key], i = value(i + 1)
+                if i < size and kinds[i] == COMMA:
+                    i += 1
+                    continue
+                expect(i, RBRACE)
+                return result, i + 1
+        if kind in LITERALS:
+            return LITERALS[kind], i + 1
+        raise SyntaxError(f"token inesperado em {starts[i]}: {tokens.text(i)!r}")
+
+    if many:
+        documents, i = [], 0
+        while i < size:
+            result, i = value(i)
+            documents.append(result)
+        return documents
+
+    result, i = value(0)
+    if i != size:
+        raise SyntaxError(f"conteúdo após o fim do documento em {starts[i]}")
+    return result
+
+
+def loads(text: str):
+    return parse_tokens(lex_array(text))
+
+
+#
+# Arquivos NDJSON grandes, com um documento por linha. Strings JSON não podem
+# conter quebras de linha literais, então todo b"\n" é uma fronteira segura:
+# o arquivo é dividido em trechos terminados em b"\n", cada processo mapeia o
+# arquivo com mmap e separa os tokens do seu trecho, e os arrays são
+# concatenados na ordem original.
+#
+def ndjson_chunks(path, chunk_size: int = 1 << 22) -> list:
+    """
+    Divide o arquivo em trechos de aproximadamente chunk_size bytes, cada um
+    terminando logo após uma quebra de linha. Retorna pares (início, fim).
+    """
+    with open(path, "rb") as file:
+        size = os.fstat(file.fileno()).st_size
+        if size == 0:
+            return []
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            chunks, start = [], 0
+            while start < size:
+                end = data.find(b"\n", min(start + chunk_size, size) - 1)
+                end = size if end == -1 else end + 1
+                chunks.append((start, end))
+                start = end
+    return chunks
+
+
+def lex_chunk(path, start: int, end: int, offset: int, line: int, recover: bool):
+    """
+    Separa os tokens dos bytes [start, end) do arquivo. As posições são
+    deslocadas por offset e as linhas por line, a posição e a linha onde o
+    trecho começa no texto completo.
+    """
+    with open(path, "rb") as file:
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            text = data[start:end].decode()
+
+    def shift(error):
+        return LexError(error.message, error.pos + offset, error.line + line - 1, error.column)
+
+    errors = [] if recover else None
+    try:
+        tokens = lex_array(text, errors)
+    except LexError as ex:
+        raise shift(ex) from None
+    errors = [shift(error) for error in errors or ()]
+    if offset == 0:
+        return tokens.kinds, tokens.starts, tokens.ends, errors
+    return (
+        tokens.kinds,
+        array("I", [pos + offset for pos in tokens.starts]),
+        array("I", [pos + offset for pos in tokens.ends]),
+        errors,
+    )
+
+
+def chunk_text_size(path, start: int, end: int) -> tuple:
+    """
+    Retorna o número de caracteres e de quebras de linha dos bytes
+    [start, end) do arquivo, depois de decodificados.
+    """
+    with open(path, "rb") as file:
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            chunk = data[start:end]
+    return len(chunk.decode()), chunk.count(b"\n")
+
+
+def lex_ndjson(path, workers: int = None, chunk_size: int = 1 << 22,
+               errors: list = None, text: bool = True) -> Tokens:
+    """
+    Equivalente a lex_array() sobre o texto de um arquivo NDJSON, mas com os
+    trechos do arquivo processados num pool de processos. Os processos
+    leem o arquivo pelo mmap em vez de receber o texto. Com workers=1 tudo
+    roda no processo atual.
+
+    Se errors for uma lista, recebe os erros de todos os trechos, na ordem
+    do arquivo, com posições e linhas relativas ao arquivo inteiro.
+
+    Com text=False, Tokens.src fica vazio e o arquivo não é decodificado no
+    processo principal: bastam os tipos e as posições, mas Tokens.value() e
+    parse_tokens() precisam do texto.
+    """
+    chunks = ndjson_chunks(path, chunk_size)
+    paths = [path] * len(chunks)
+    starts = [start for start, _ in chunks]
+    ends = [end for _, end in chunks]
+    if workers == 1:
+        run = map
+    else:
+        pool = ProcessPoolExecutor(workers)
+        run = pool.map
+
+    try:
+        # Os processos medem seus trechos em caracteres; a soma dá a posição
+        # onde cada trecho começa no texto completo
+        offsets, lines, offset, line = [], [], 0, 1
+        for chars, newlines in run(chunk_text_size, paths, starts, ends):
+            offsets.append(offset)
+            lines.append(line)
+            offset += chars
+            line += newlines
+
+        flags = [errors is not None] * len(chunks)
+        results = run(lex_chunk, paths, starts, ends, offsets, lines, flags)
+
+        # Enquanto os processos separam os tokens, o texto é decodificado de
+        # uma vez, direto do mmap
+        src = ""
+        if text and chunks:
+            with open(path, "rb") as file:
+                with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                    with memoryview(data) as view:
+                        src = str(view, "utf-8")
+
+        tokens = Tokens(src, array("B"), array("I"), array("I"))
+        for kinds, chunk_starts, chunk_ends, chunk_errors in results:
+            tokens.kinds.extend(kinds)
+            tokens.starts.extend(chunk_starts)
+            tokens.ends.extend(chunk_ends)
+            if errors is not None:
+                errors.extend(chunk_errors)
+    finally:
+        if workers != 1:
+            pool.shutdown()
+    return tokens
+
+
+def load_ndjson(path, workers: int = None) -> list:
+    return parse_tokens(lex_ndjson(path, workers), many=True)
 
 
 # Exemplos
@@ -48,5 +450,95 @@ examples = [
 ]
 for doc in examples:
     print('In: ', repr(doc))
-    pprint(lex(doc))
+    try:
+        pprint(lex(doc))
+    except SystemError as ex:
+        print('Erro:', ex)
     print()
+
+tokens = lex_array('{"answer": [42, 3.14, "\\u00e9", true, null]}')
+print([KIND_NAMES[kind] for kind in tokens.kinds])
+print(tokens.starts, tokens.ends)
+print(loads(tokens.src))
+
+# Expoentes sem sinal e escapes \uXXXX só com dígitos hexadecimais
+assert loads('[1e5, 2E-3, "\\u00E9"]') == [1e5, 2e-3, "é"]
+assert [token.value for token in lex("1e5")] == [1e5]
+for doc in ['"\\u00zz"', '"\\uGHIJ"']:
+    try:
+        loads(doc)
+    except SystemError:
+        pass
+    else:
+        raise AssertionError(doc)
+
+# Modo de recuperação: todos os erros numa única passada
+errors = []
+lex('[1, 2]\n{"a": tru, "b": 3}\n[4 @ 5, 6]\n', errors)
+for error in errors:
+    print('Erro:', error)
+
+
+def benchmark():
+    """
+    Compara lex(), que cria um Token por lexema e usava eval() nos valores,
+    com lex_array() seguido de parse_tokens().
+    """
+    import json
+    import time
+
+    doc = json.dumps([{"id": i, "name": f"item {i}", "price": i * 1.5, "tags": ["a", "b\\n"]}
+                      for i in range(20_000)])
+
+    def timeit(func):
+        start = time.perf_counter()
+        func()
+        return time.perf_counter() - start
+
+    lex_time = timeit(lambda: lex(doc))
+    array_time = timeit(lambda: lex_array(doc))
+    tokens = lex_array(doc)
+    parse_time = timeit(lambda: parse_tokens(tokens))
+    assert parse_tokens(tokens) == json.loads(doc)
+
+    mb = len(doc) / 1e6
+    print(f"lex:          {mb / lex_time:6.2f} MB/s")
+    print(f"lex_array:    {mb / array_time:6.2f} MB/s")
+    print(f"parse_tokens: {mb / parse_time:6.2f} MB/s")
+    print(f"memória dos tokens: {sum(a.itemsize * len(a) for a in tokens[1:]) / 1e6:.1f} MB "
+          f"para {len(tokens)} tokens")
+
+
+def benchmark_ndjson(size_mb=64):
+    """
+    Mede lex_ndjson() num arquivo NDJSON temporário com 1, 2, 4 e 8 processos.
+    """
+    import json
+    import tempfile
+    import time
+
+    line = json.dumps({"id": 1, "name": "item", "price": 1.5, "tags": ["a", "b\\n", "é"]})
+    count = size_mb * 1_000_000 // (len(line) + 1)
+    with tempfile.NamedTemporaryFile("w", suffix=".ndjson", delete=False) as file:
+        for i in range(count):
+            file.write(line.replace("1", str(i), 1) + "\n")
+    try:
+        print(f"{size_mb} MB, {count} linhas, {os.cpu_count()} CPUs")
+        start = time.perf_counter()
+        with open(file.name) as f:
+            expected = lex_array(f.read())
+        baseline = time.perf_counter() - start
+        print(f"lex_array: {size_mb / baseline:6.2f} MB/s")
+        for workers in (1, 2, 4, 8):
+            start = time.perf_counter()
+            tokens = lex_ndjson(file.name, workers=workers)
+            elapsed = time.perf_counter() - start
+            assert tokens == expected
+            print(f"{workers:3} processos: {size_mb / elapsed:6.2f} MB/s ({baseline / elapsed:.1f}x)")
+    finally:
+        os.unlink(file.name)
+
+
+if __name__ == "__main__":
+    benchmark()
+    benchmark_ndjson()
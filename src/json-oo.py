@@ -1,40 +1,79 @@
+import codecs
+import io
+import json
+import mmap
+import re
+
+from json_common import cache_key, compact, unescape
+
+
 class Reader:
+    # Apenas os espaços do JSON, como em BytesReader
+    WS = re.compile(r"[ \t\n\r]*")
+    key_cache = None
+    records = False
+
     def __init__(self, src, pos=0):
-        self.src = src.strip()
+        self.src = src.strip(" \t\n\r")
         self.pos = pos
 
     def read(self, st):
         """
-        Lê sub-string "st" na posição atual.
+        Lê sub-string "st" na posição atual, ignorando espaços antes dela.
         """
+        self.pos = self.WS.match(self.src, self.pos).end()
         if not self.src.startswith(st, self.pos):
             raise SyntaxError(f"espera {st!r}")
         self.pos += len(st)
 
-    def check_EOF(self):
-        rest = self.src[self.pos :]
-        if not (rest == "" or rest.isspace()):
-            raise SyntaxError(f"espera EOF, obteve {rest!r}")
+    def peek(self):
+        """
+        Pula espaços e retorna o próximo caractere, sem consumi-lo. Lança
+        IndexError no fim do texto.
+        """
+        self.pos = self.WS.match(self.src, self.pos).end()
+        return self.src[self.pos]
 
+    def check_EOF(self):
+        if self.WS.match(self.src, self.pos).end() != len(self.src):
+            raise SyntaxError(f"espera EOF, obteve {self.src[self.pos :]!r}")
 
 class JSAtomsMixin(Reader):
+    NUMBER = re.compile(r"-?(?:0|[1-9][0-9]*)(\.[0-9]+)?([eE][+-]?[0-9]+)?")
+    STRING = re.compile(r'"([^"\\]*(?:\\.[^"\\]*)*)"', re.S)
+
     def read_number(self):
-        self.pos_end = self.pos
-        while self.pos_end < len(self.src) and self.src[self.pos_end].isdigit():
-            self.pos_end += 1
-        n = int(self.src[self.pos : self.pos_end])
-        self.pos = self.pos_end
-        return n
+        m = self.NUMBER.match(self.src, self.pos)
+        if m is None:
+            raise SyntaxError(f"espera número, obteve {self.src[self.pos :]!r}")
+        self.pos = m.end()
+        if m.group(1) is None and m.group(2) is None:
+            return int(m.group())
+        return float(m.group())
 
     def read_string(self):
+        # Caso comum: sem escapes, basta procurar as aspas finais
         self.pos_end = self.src.find('"', self.pos + 1)
         st = self.src[self.pos + 1 : self.pos_end]
+        if "\\" in st:
+            m = self.STRING.match(self.src, self.pos)
+            if m is None:
+                # A regex só falha se faltam as aspas finais: o erro está no
+                # fim do texto
+                self.pos = len(self.src)
+                raise SyntaxError("string sem aspas finais")
+            self.pos_end = m.end() - 1
+            st = unescape(m.group(1))
+        elif self.pos_end == -1:
+            self.pos = len(self.src)
+            raise SyntaxError("string sem aspas finais")
         self.pos = self.pos_end + 1
         return st
 
 
 class JSONReader(JSAtomsMixin, Reader):
     def read_value(self):
+        char = self.peek()
         if self.src.startswith("true", self.pos):
             self.pos += 4
             return True
@@ -44,61 +83,516 @@ class JSONReader(JSAtomsMixin, Reader):
         elif self.src.startswith("null", self.pos):
             self.pos += 4
             return None
-        elif self.src[self.pos].isdigit():
+        elif char == "-" or char.isdigit():
             return self.read_number()
-        elif self.src[self.pos] == '"':
+        elif char == '"':
             return self.read_string()
-        elif self.src[self.pos] == "[":
+        elif char == "[":
             return self.read_array()
-        elif self.src[self.pos] == "{":
+        elif char == "{":
             return self.read_object()
         else:
             raise SyntaxError(f"unexpected {self.src[self.pos:]!r}")
 
     def read_array(self):
         self.pos += 1
-        if self.src[self.pos] == "]":
+        if self.peek() == "]":
             self.pos += 1
             return []
 
         elements = [self.read_value()]
         while True:
-            if self.src[self.pos] == "]":
+            if self.peek() == "]":
                 self.pos += 1
-                return elements
+                return compact(elements) if self.records else elements
             self.read(",")
             elements.append(self.read_value())
 
     def read_object(self):
         self.pos += 1
-        if self.src[self.pos] == "}":
+        if self.peek() == "}":
             self.pos += 1
             return {}
 
         elements = [self.read_pair()]
         while True:
-            if self.src[self.pos] == "}":
+            if self.peek() == "}":
                 self.pos += 1
                 return dict(elements)
             self.read(",")
             elements.append(self.read_pair())
 
     def read_pair(self):
+        if self.peek() != '"':
+            raise SyntaxError(f"espera chave, obteve {self.src[self.pos:]!r}")
         key = self.read_string()
+        if self.key_cache is not None:
+            key = cache_key(self.key_cache, key)
         self.read(":")
         value = self.read_value()
         return (key, value)
 
 
-def loads(text: str) -> object:
+class BytesReader(Reader):
+    """
+    Leitor que percorre um buffer com texto UTF-8 (bytes, bytearray,
+    memoryview ou mmap) sem copiá-lo nem decodificá-lo por inteiro.
+
+    Toda a varredura é feita com regexes sobre o próprio buffer. Apenas os
+    trechos que viram valores (strings e números) são copiados.
+    """
+
+    WS = re.compile(rb"[ \t\n\r]*")
+
+    def __init__(self, src, pos=0):
+        self.src = src
+        self.pos = pos
+
+    def skip_spaces(self):
+        self.pos = self.WS.match(self.src, self.pos).end()
+
+    def read(self, st):
+        """
+        Lê os bytes "st" na posição atual, ignorando espaços antes deles.
+        """
+        self.skip_spaces()
+        if self.src[self.pos : self.pos + len(st)] != st:
+            raise SyntaxError(f"espera {st.decode()!r}")
+        self.pos += len(st)
+
+    def peek(self):
+        """
+        Pula espaços e retorna o próximo byte (como inteiro), sem consumi-lo.
+        """
+        self.skip_spaces()
+        if self.pos >= len(self.src):
+            raise SyntaxError("fim inesperado da entrada")
+        return self.src[self.pos]
+
+    def check_EOF(self):
+        self.skip_spaces()
+        if self.pos != len(self.src):
+            rest = bytes(self.src[self.pos : self.pos + 40])
+            raise SyntaxError(f"espera EOF, obteve {rest!r}")
+
+
+class JSBytesAtomsMixin(BytesReader):
+    NUMBER = re.compile(rb"-?(?:0|[1-9][0-9]*)(\.[0-9]+)?([eE][+-]?[0-9]+)?")
+    STRING = re.compile(rb'"([^"\\]*(?:\\.[^"\\]*)*)"', re.S)
+
+    def read_number(self):
+        m = self.NUMBER.match(self.src, self.pos)
+        if m is None:
+            raise SyntaxError("espera número")
+        self.pos = m.end()
+        if m.group(1) is None and m.group(2) is None:
+            return int(m.group())
+        return float(m.group())
+
+    def read_string(self):
+        m = self.STRING.match(self.src, self.pos)
+        if m is None:
+            raise SyntaxError("string inválida")
+        self.pos = m.end()
+        raw = m.group(1)
+        st = raw.decode("utf-8")
+        if b"\\" in raw:
+            st = unescape(st)
+        return st
+
+
+class JSONBytesReader(JSBytesAtomsMixin, BytesReader):
+    """
+    Equivalente a JSONReader para buffers de bytes. Aceita espaços em branco
+    entre os elementos e números com sinal, fração e expoente.
+    """
+
+    LITERALS = {b"t": (b"true", True), b"f": (b"false", False), b"n": (b"null", None)}
+
+    def read_value(self):
+        char = self.peek()
+        if char == ord('"'):
+            return self.read_string()
+        elif char == ord("["):
+            return self.read_array()
+        elif char == ord("{"):
+            return self.read_object()
+        elif char == ord("-") or ord("0") <= char <= ord("9"):
+            return self.read_number()
+        elif bytes((char,)) in self.LITERALS:
+            lit, value = self.LITERALS[bytes((char,))]
+            self.read(lit)
+            return value
+        else:
+            rest = bytes(self.src[self.pos : self.pos + 40])
+            raise SyntaxError(f"unexpected {rest!r}")
+
+    def read_array(self):
+        self.pos += 1
+        if self.peek() == ord("]"):
+            self.pos += 1
+            return []
+
+        elements = [self.read_value()]
+        while True:
+            if self.peek() == ord("]"):
+                self.pos += 1
+                return compact(elements) if self.records else elements
+            self.read(b",")
+            elements.append(self.read_value())
+
+    def read_object(self):
+        self.pos += 1
+        if self.peek() == ord("}"):
+            self.pos += 1
+            return {}
+
+        elements = [self.read_pair()]
+        while True:
+            if self.peek() == ord("}"):
+                self.pos += 1
+                return dict(elements)
+            self.read(b",")
+            elements.append(self.read_pair())
+
+    def read_pair(self):
+        if self.peek() != ord('"'):
+            raise SyntaxError("espera chave")
+        key = self.read_string()
+        if self.key_cache is not None:
+            key = cache_key(self.key_cache, key)
+        self.read(b":")
+        value = self.read_value()
+        return (key, value)
+
+
+def loads(text: str, cache_keys: bool = False, records: bool = False) -> object:
     """
     Carrega um documento JSON e retorna o valor Python correspondente.
+
+    Além de str, aceita bytes, bytearray, memoryview ou mmap com o documento
+    codificado em UTF-8. Esses buffers são lidos diretamente, sem
+    decodificar o documento inteiro, e aceitam exatamente os mesmos
+    documentos que str.
+
+    Com cache_keys=True, chaves repetidas dos objetos passam a compartilhar
+    o mesmo objeto str. Com records=True, listas de objetos com as mesmas
+    chaves são retornadas como Records.
     """
-    reader = JSONReader(text)
-    value = reader.read_value()
+    if isinstance(text, str):
+        reader = JSONReader(text)
+    else:
+        reader = JSONBytesReader(text)
+    if cache_keys:
+        reader.key_cache = {}
+    reader.records = records
+    try:
+        value = reader.read_value()
+    except IndexError:
+        # JSONReader indexa o texto diretamente e esbarra no fim dele
+        raise SyntaxError("fim inesperado da entrada") from None
     reader.check_EOF()
     return value
-    
+
+
+def load(fp, **options) -> object:
+    """
+    Carrega um documento JSON de um arquivo aberto, mapeando-o na memória
+    com mmap em vez de lê-lo para uma string. Aceita as mesmas opções de
+    loads().
+    """
+    try:
+        buf = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+    except (AttributeError, OSError, ValueError):
+        # Arquivos vazios ou sem descritor (ex.: io.StringIO) não são mapeáveis
+        return loads(fp.read(), **options)
+    with buf:
+        return loads(buf, **options)
+
+
+class JSONStreamReader(JSONReader):
+    """
+    Lê uma sequência de documentos JSON a partir de pedaços de texto.
+
+    Mantém na memória apenas o texto do documento atual: o que já foi lido é
+    descartado sempre que um novo pedaço chega. Se um documento não termina
+    dentro do buffer, a leitura recomeça do seu início depois de ler pedaços
+    suficientes para, pelo menos, dobrar o buffer. Assim cada caractere é
+    relido apenas um número constante de vezes, em média.
+
+    Um erro longe do fim do buffer é levantado na hora, sem ler o resto da
+    entrada.
+    """
+
+    # Um número lido até perto do fim do buffer pode continuar no próximo
+    # pedaço: "1" + ".5" ou "1e" + "+5". Exigimos essa folga após um valor.
+    MARGIN = 2
+
+    # Um erro a menos que isso do fim do buffer pode ser só um token cortado
+    # ao meio, como "fal" + "se"
+    LOOKAHEAD = len("false")
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.decoder = codecs.getincrementaldecoder("utf-8")()
+        self.src = ""
+        self.pos = 0
+        self.eof = False
+
+    def __iter__(self):
+        while self.skip_spaces():
+            yield self.read_complete(self.read_value)
+
+    def read_complete(self, read):
+        """
+        Executa read() a partir da posição atual, lendo mais pedaços e
+        recomeçando sempre que a leitura esbarra no fim do buffer.
+        """
+        while True:
+            start = self.pos
+            try:
+                value = read()
+                if self.pos < len(self.src) - self.MARGIN or self.eof:
+                    return value
+            except IndexError:
+                truncated = True
+            except SyntaxError:
+                truncated = self.pos + self.LOOKAHEAD >= len(self.src)
+            else:
+                truncated = True
+            if not truncated or self.eof:
+                self.pos = len(self.src)
+                doc = self.src[start : start + 40]
+                raise SyntaxError(f"documento inválido: {doc!r}")
+            self.pos = start
+            self.grow()
+
+    def next_chunk(self):
+        """
+        Retorna o próximo pedaço não vazio da entrada, já decodificado, ou
+        None no fim da entrada.
+        """
+        for chunk in self.chunks:
+            if isinstance(chunk, (bytes, bytearray)):
+                chunk = self.decoder.decode(chunk)
+            if chunk:
+                return chunk
+        self.eof = True
+        # Bytes que ficaram no decodificador são um caractere UTF-8 cortado
+        self.decoder.decode(b"", final=True)
+        return None
+
+    def feed(self, target=0):
+        """
+        Descarta o texto já consumido e acrescenta pedaços ao buffer até que
+        ele tenha pelo menos "target" caracteres, juntando-os uma única vez.
+        Retorna False se a entrada já tinha acabado.
+        """
+        pieces = [self.src[self.pos :]]
+        size = len(pieces[0])
+        while True:
+            chunk = self.next_chunk()
+            if chunk is None:
+                break
+            pieces.append(chunk)
+            size += len(chunk)
+            if size >= target:
+                break
+        if len(pieces) == 1:
+            return False
+        self.src = "".join(pieces)
+        self.pos = 0
+        return True
+
+    def grow(self):
+        """
+        Lê pedaços até que o buffer dobre de tamanho ou a entrada acabe.
+        """
+        self.feed(2 * (len(self.src) - self.pos))
+
+    def skip_spaces(self):
+        """
+        Pula espaços entre documentos. Retorna False se não houver mais
+        nenhum documento na entrada.
+        """
+        while True:
+            self.pos = self.WS.match(self.src, self.pos).end()
+            if self.pos < len(self.src):
+                return True
+            if not self.feed():
+                return False
+
+
+class JSONEventReader(JSONStreamReader):
+    """
+    Leitor de JSON no estilo "pull": em vez de construir listas e
+    dicionários, produz eventos (tipo, valor) à medida que lê a entrada.
+
+    Os tipos de evento são "start_object", "key", "end_object",
+    "start_array", "end_array" e "scalar". Apenas um token por vez precisa
+    estar no buffer e os contêineres abertos ficam numa pilha, de modo que a
+    memória usada é proporcional à profundidade do documento.
+    """
+
+    def __iter__(self):
+        stack = []
+        while True:
+            if not self.skip_spaces():
+                if stack:
+                    raise SyntaxError("fim inesperado da entrada")
+                return
+
+            char = self.src[self.pos]
+            if char in "[{":
+                self.pos += 1
+                close = "]" if char == "[" else "}"
+                yield ("start_array" if char == "[" else "start_object"), None
+                if self.next_char() != close:
+                    stack.append(close)
+                    if close == "}":
+                        yield "key", self.read_key()
+                    continue
+                self.pos += 1
+                yield ("end_array" if char == "[" else "end_object"), None
+            else:
+                yield "scalar", self.read_complete(self.read_value)
+
+            # Depois de um valor: fecha contêineres ou lê o separador
+            while stack:
+                char = self.next_char()
+                self.pos += 1
+                if char == stack[-1]:
+                    stack.pop()
+                    yield ("end_array" if char == "]" else "end_object"), None
+                elif char == ",":
+                    if stack[-1] == "}":
+                        yield "key", self.read_key()
+                    break
+                else:
+                    raise SyntaxError(f"espera ',' ou {stack[-1]!r}, obteve {char!r}")
+
+    def next_char(self):
+        """
+        Pula espaços e retorna o próximo caractere, sem consumi-lo.
+        """
+        if not self.skip_spaces():
+            raise SyntaxError("fim inesperado da entrada")
+        return self.src[self.pos]
+
+    def read_key(self):
+        if self.next_char() != '"':
+            raise SyntaxError(f"espera chave, obteve {self.src[self.pos]!r}")
+        key = self.read_complete(self.read_string)
+        self.next_char()
+        self.read(":")
+        return key
+
+
+def read_chunks(fp, chunk_size=65536):
+    """
+    Retorna um iterável com pedaços de texto de um arquivo ou o próprio
+    iterável recebido.
+    """
+    if hasattr(fp, "read"):
+        return iter(lambda: fp.read(chunk_size), fp.read(0))
+    return fp
+
+
+def iterload(fp, chunk_size=65536):
+    """
+    Itera sobre os documentos JSON de um arquivo ou de um iterável com
+    pedaços de texto, como em NDJSON ou documentos concatenados.
+    """
+    return iter(JSONStreamReader(read_chunks(fp, chunk_size)))
+
+
+def iterevents(fp, chunk_size=65536):
+    """
+    Itera sobre os eventos (tipo, valor) dos documentos JSON em "fp".
+    """
+    return iter(JSONEventReader(read_chunks(fp, chunk_size)))
+
+
+def select(fp, path, chunk_size=65536):
+    """
+    Itera sobre os valores que casam com o caminho "path", como em
+    "items.*.id". Cada componente é uma chave de objeto ou um índice de
+    lista, e "*" casa com qualquer um deles.
+
+    As partes do documento fora do caminho são percorridas sem construir os
+    valores correspondentes.
+    """
+    pattern = path.split(".") if path else []
+    events = iterevents(fp, chunk_size)
+    for event, value in events:
+        yield from select_events(events, event, value, pattern)
+
+
+def select_events(events, event, value, pattern):
+    """
+    Seleciona os caminhos que casam com "pattern" dentro do valor iniciado
+    pelo evento (event, value).
+    """
+    if not pattern:
+        yield build_value(events, event, value)
+    elif event == "start_object":
+        for event, key in events:
+            if event == "end_object":
+                return
+            event, value = next(events)
+            if pattern[0] in ("*", key):
+                yield from select_events(events, event, value, pattern[1:])
+            else:
+                skip_value(events, event)
+    elif event == "start_array":
+        index = 0
+        for event, value in events:
+            if event == "end_array":
+                return
+            if pattern[0] in ("*", str(index)):
+                yield from select_events(events, event, value, pattern[1:])
+            else:
+                skip_value(events, event)
+            index += 1
+    else:
+        skip_value(events, event)
+
+
+def skip_value(events, event):
+    """
+    Consome os eventos do valor iniciado por "event" sem construí-lo.
+    """
+    if event not in ("start_object", "start_array"):
+        return
+    depth = 1
+    for event, _ in events:
+        if event in ("start_object", "start_array"):
+            depth += 1
+        elif event in ("end_object", "end_array"):
+            depth -= 1
+            if depth == 0:
+                return
+
+
+def build_value(events, event, value):
+    """
+    Constrói o valor Python iniciado pelo evento (event, value).
+    """
+    if event == "start_object":
+        obj = {}
+        for event, key in events:
+            if event == "end_object":
+                return obj
+            obj[key] = build_value(events, *next(events))
+    elif event == "start_array":
+        elements = []
+        for event, value in events:
+            if event == "end_array":
+                return elements
+            elements.append(build_value(events, event, value))
+    return value
+
+
 
 # Exemplos
 print(loads("true"))
@@ -108,3 +602,31 @@ print(loads("42"))
 print(loads('"Hello World"'))
 print(loads("[true,false,null,[1,2,3,[]]]"))
 print(loads('{"answer":[1,2,[]]}'))
+print(loads(b'{ "answer" : [-1, 2.5e3, "caf\xc3\xa9 \\u00e9"] }'))
+print(loads('[{"x":1,"y":2},{"x":3,"y":4}]', cache_keys=True, records=True))
+print(list(iterload(['{"answer":[1', ',2,[]]}\n[t', 'rue]\n"Hello', ' World"42'])))
+print(list(iterevents(['{"answer":[1', ',2,[]]}'])))
+print(list(select(['{"items": [{"id": 1, "tags": ["a"]}, {"i', 'd": 2}]}'], "items.*.id")))
+
+# Saída de json.dumps, com espaços entre os elementos, em pedaços de 1 a 7
+# caracteres: como NDJSON e como documentos indentados concatenados
+docs = [{"a": [1, 2.5, None]}, [True, {"b": "c d", "e": {}}], "x", -3e-2, {}, []]
+for text in [
+    "".join(json.dumps(doc) + "\n" for doc in docs),
+    "".join(json.dumps(doc, indent=2) for doc in docs),
+]:
+    for size in range(1, 8):
+        chunks = [text[i : i + size] for i in range(0, len(text), size)]
+        assert list(iterload(chunks)) == docs
+    assert list(iterload(io.StringIO(text))) == docs
+assert list(iterload(['{"a": 1}\n{"a": 2}\n'])) == [{"a": 1}, {"a": 2}]
+
+# str e bytes aceitam os mesmos documentos e falham nos mesmos casos
+for doc in [' { "a" : [ 1 , -2.5e3 , "\\u00e9" ] } ', "[\t1,\r\n2]", "[1,", "[1 2]", "\u00a0[]"]:
+    results = []
+    for src in [doc, doc.encode()]:
+        try:
+            results.append(loads(src))
+        except SyntaxError:
+            results.append(SyntaxError)
+    assert results[0] == results[1], (doc, results)
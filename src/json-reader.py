@@ -1,21 +1,41 @@
+import re
+
+from json_common import cache_key, compact, unescape
+
+NUMBER = re.compile(r"-?(?:0|[1-9][0-9]*)(\.[0-9]+)?([eE][+-]?[0-9]+)?")
+STRING = re.compile(r'"([^"\\]*(?:\\.[^"\\]*)*)"')
+WS = re.compile(r"[ \t\n\r]*")
+
 src = ""
 pos = 0
+key_cache = None
+use_records = False
 
 
-def loads(text: str) -> object:
+def loads(text: str, cache_keys: bool = False, records: bool = False) -> object:
     """
     Carrega um documento JSON e retorna o valor Python correspondente.
+    Aceita apenas str: para ler bytes, memoryview ou mmap sem decodificar o
+    documento inteiro, use loads() de json-oo.py.
+
+    Com cache_keys=True, chaves repetidas dos objetos passam a compartilhar
+    o mesmo objeto str. Com records=True, listas de objetos com as mesmas
+    chaves são retornadas como Records.
     """
-    global src, pos
+    global src, pos, key_cache, use_records
 
     src = text
     pos = 0
-    value = read_value()
-    rest = src[pos:]
-    if rest == '' or rest.isspace():
+    key_cache = {} if cache_keys else None
+    use_records = records
+    try:
+        value = read_value()
+    finally:
+        key_cache, use_records = None, False
+    if WS.match(src, pos).end() == len(src):
         return value
     else:
-        raise SyntaxError(f'espera EOF, obteve {rest!r}')
+        raise SyntaxError(f'espera EOF, obteve {src[pos:]!r}')
 
 
 def read_value():
@@ -30,10 +50,7 @@ def read_value():
     elif src.startswith("null", pos):
         pos += 4
         return None
-    elif src[pos] == '-':
-        pos += 1
-        return -read_number()
-    elif src[pos].isdigit():
+    elif src[pos] == '-' or src[pos].isdigit():
         return read_number()
     elif src[pos] == '"':
         return read_string()
@@ -48,19 +65,29 @@ def read_value():
 def read_number():
     global pos
 
-    pos_end = pos
-    while pos_end < len(src) and src[pos_end].isdigit():
-        pos_end += 1
-    n = int(src[pos:pos_end])
-    pos = pos_end
-    return n
+    m = NUMBER.match(src, pos)
+    if m is None:
+        raise SyntaxError(f"espera número, obteve {src[pos:]!r}")
+    pos = m.end()
+    if m.group(1) is None and m.group(2) is None:
+        return int(m.group())
+    return float(m.group())
 
 
 def read_string():
     global pos
 
+    # Caso comum: sem escapes, basta procurar as aspas finais
     pos_end = src.find('"', pos + 1)
     st = src[pos + 1 : pos_end]
+    if "\\" in st:
+        m = STRING.match(src, pos)
+        if m is None:
+            raise SyntaxError(f"string inválida: {src[pos:]!r}")
+        pos_end = m.end() - 1
+        st = unescape(m.group(1))
+    elif pos_end == -1:
+        raise SyntaxError(f"string inválida: {src[pos:]!r}")
     pos = pos_end + 1
     return st
 
@@ -77,7 +104,7 @@ def read_array():
     while True:
         if src[pos] == "]":
             pos += 1
-            return elements
+            return compact(elements) if use_records else elements
         read(",")
         elements.append(read_value())
 
@@ -101,6 +128,8 @@ def read_object():
 
 def read_pair():
     key = read_string()
+    if key_cache is not None:
+        key = cache_key(key_cache, key)
     read(":")
     value = read_value()
     return (key, value)
@@ -123,6 +152,8 @@ print(loads("-42"))
 print(loads('"Hello World"'))
 print(loads("[true,false,null,[1,2,3,[]]]"))
 print(loads('{"answer":[1,2,[]]}'))
+print(loads('[-1.5e3,"tab\\tquote\\"\\u00e9"]  '))
+print(loads('[{"x":1,"y":2},{"x":3,"y":4}]', cache_keys=True, records=True))
 
 # Exercícios
 # 1. Implemente suporte para números negativos.
@@ -137,3 +168,62 @@ print(loads('{"answer":[1,2,[]]}'))
 # >>> print(loads("  42  "))
 # >>> print(loads("  [ 1 , 2 , 3 ]  "))
 # >>> print(loads('  { "key" : "value" }  '))
+
+
+def benchmark():
+    """
+    Compara, para cada tipo de token, a leitura caractere a caractere
+    (versão anterior) com a leitura por regex.
+    """
+    from timeit import timeit
+
+    def loop_number():
+        global pos
+
+        pos_end = pos
+        while pos_end < len(src) and src[pos_end].isdigit():
+            pos_end += 1
+        n = int(src[pos:pos_end])
+        pos = pos_end
+        return n
+
+    def loop_string():
+        global pos
+
+        pos_end = src.find('"', pos + 1)
+        st = src[pos + 1 : pos_end]
+        pos = pos_end + 1
+        return st
+
+    def loop_spaces():
+        global pos
+
+        while pos < len(src) and src[pos].isspace():
+            pos += 1
+
+    def regex_spaces():
+        global pos
+
+        pos = WS.match(src, pos).end()
+
+    def run(reader, text):
+        global src, pos
+
+        src, pos = text, 0
+        reader()
+
+    cases = [
+        ("number", "1234567890123" * 3 + ",", loop_number, read_number),
+        ("string", '"' + "lorem ipsum " * 20 + '"', loop_string, read_string),
+        ("spaces", " \n\t " * 50 + "x", loop_spaces, regex_spaces),
+    ]
+    n = 100_000
+    for name, text, before, after in cases:
+        t_before = timeit(lambda: run(before, text), number=n)
+        t_after = timeit(lambda: run(after, text), number=n)
+        print(f"{name}: antes {1e9 * t_before / n:.0f} ns, "
+              f"depois {1e9 * t_after / n:.0f} ns ({t_before / t_after:.1f}x)")
+
+
+if __name__ == "__main__":
+    benchmark()
@@ -0,0 +1,123 @@
+"""
+Funções compartilhadas pelas implementações de JSON deste diretório.
+
+Os scripts json-*.py e combinators-lib.py importam este módulo, como
+fazem com grammar_cache, para que todos decodifiquem strings da mesma
+forma, lancem os mesmos erros e implementem as opções cache_keys e
+records de loads() do mesmo jeito. As versões com lark também usam
+save_standalone() e load_standalone().
+"""
+import importlib.util
+import re
+from typing import Any, NamedTuple, Optional
+
+ESCAPE = re.compile(r"\\(u[0-9a-fA-F]{4}|.)", re.S)
+SURROGATE = re.compile(r"[\ud800-\udfff]")
+ESCAPES = {
+    '"': '"', "\\": "\\", "/": "/", "b": "\b", "f": "\f", "n": "\n", "r": "\r", "t": "\t"
+}
+
+
+def unescape(st: str) -> str:
+    """
+    Substitui as sequências de escape do conteúdo de uma string JSON, sem as
+    aspas, pelos caracteres correspondentes.
+
+    Lança SyntaxError para escapes inválidos, como "\\x" ou uma barra antes
+    de uma quebra de linha, e para surrogates sem par, como "\\ud800".
+    """
+    st = ESCAPE.sub(replace_escape, st)
+    if SURROGATE.search(st):
+        # Junta pares como "\ud83d\ude00" num único caractere
+        try:
+            st = st.encode("utf-16", "surrogatepass").decode("utf-16")
+        except UnicodeDecodeError:
+            raise SyntaxError(f"surrogate sem par: {st!r}") from None
+    return st
+
+
+def replace_escape(m: re.Match) -> str:
+    """
+    Retorna o caractere correspondente a uma sequência de escape.
+    """
+    esc = m.group(1)
+    if len(esc) == 5:
+        return chr(int(esc[1:], 16))
+    try:
+        return ESCAPES[esc]
+    except KeyError:
+        raise SyntaxError(f"escape inválido: \\{esc}") from None
+
+
+# Número máximo de chaves distintas guardadas no cache de uma leitura
+KEY_CACHE_SIZE = 4096
+
+
+class Records(NamedTuple):
+    """
+    Lista de objetos com as mesmas chaves, guardada como uma única tupla de
+    chaves e uma tupla de valores por objeto.
+    """
+
+    keys: tuple
+    rows: list
+
+    def dicts(self) -> list:
+        return [dict(zip(self.keys, row)) for row in self.rows]
+
+
+def cache_key(cache: Optional[dict], key: str) -> str:
+    """
+    Retorna a cópia da chave guardada em "cache", guardando-a se ainda houver
+    espaço. Sem cache (None), retorna a própria chave.
+    """
+    if cache is None:
+        return key
+    try:
+        return cache[key]
+    except KeyError:
+        if len(cache) < KEY_CACHE_SIZE:
+            cache[key] = key
+        return key
+
+
+def compact(elements: list) -> Any:
+    """
+    Converte uma lista de objetos com as mesmas chaves, na mesma ordem, em
+    Records. Outras listas são retornadas sem mudanças.
+    """
+    if not elements or type(elements[0]) is not dict:
+        return elements
+    keys = tuple(elements[0])
+    rows = []
+    for obj in elements:
+        if type(obj) is not dict or len(obj) != len(keys) or tuple(obj) != keys:
+            return elements
+        rows.append(tuple(obj.values()))
+    return Records(keys, rows)
+
+
+def save_standalone(grammar: str, path) -> None:
+    """
+    Gera um módulo Python com o parser LALR da gramática e suas tabelas já
+    calculadas, que não precisa analisar a gramática ao iniciar. O módulo
+    gerado não importa lark.
+    """
+    import lark
+    from lark.tools.standalone import gen_standalone
+
+    with open(path, "w") as fp:
+        gen_standalone(lark.Lark(grammar, parser="lalr"), out=fp)
+
+
+def load_standalone(path, transformer=None):
+    """
+    Importa o módulo gerado por save_standalone() e retorna o parser, com o
+    transformer aplicado durante a análise. Um transformer derivado de
+    lark.Transformer, como os de json-exato.py e json-grammar.py, traz de
+    volta a dependência de lark.
+    """
+    spec = importlib.util.spec_from_file_location("json_standalone", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module.Lark_StandAlone(transformer=transformer)
@@ -1,10 +1,23 @@
+import ast
+import builtins
+import itertools
 import math
 from random import random
-from lark import Lark
+from constant_folding import ArithmeticFolder, is_const, make_fold_binop, tree_size
+from grammar_cache import PARSE_CACHE_SIZE, cached_parse, load_parser
+from lark import Tree
 from lark.visitors import Interpreter, v_args
 import operator
+import os
+import pickle
+from collections import defaultdict
+from concurrent.futures import Executor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import lru_cache
+from time import perf_counter
+from typing import NamedTuple
 
-grammar = Lark(
+grammar = load_parser(
     r"""
 ?start  : block
 
@@ -12,6 +25,9 @@ grammar = Lark(
 
 ?expr   : cond
         | assign
+        | loop
+
+loop    : "loop" atom expr
 
 ?assign : NAME "=" expr
         
@@ -63,6 +79,16 @@ NAME    : ("a".."z"|"_")+
 %ignore " "
 """, parser='lalr')
 
+def parse_tree(src: str, optimize: bool = False) -> Tree:
+    tree = grammar.parse(src)
+    if optimize:
+        tree, _ = fold_constants(tree)
+    return tree
+
+
+# parse(src, optimize) reaproveita as árvores já construídas
+parse = cached_parse(parse_tree)
+
 def make_binop(fn):
     def binop(self, x, y):
         return fn(self.visit(x), self.visit(y))
@@ -93,8 +119,6 @@ class CalcEval(Interpreter):
     le = make_binop(operator.le) 
     eq = make_binop(operator.eq) 
     ne = make_binop(operator.ne)
-    and_ = make_binop(operator.and_) 
-    or_ = make_binop(operator.or_)
     int = int 
 
     def __init__(self, env):
@@ -104,6 +128,20 @@ class CalcEval(Interpreter):
 
     def not_(self, x):
         return not self.visit(x)
+
+    def and_(self, x, y):
+        return self.visit(x) and self.visit(y)
+
+    def or_(self, x, y):
+        return self.visit(x) or self.visit(y)
+
+    def loop(self, count, body):
+        # O corpo é compilado uma vez para uma função Python, em vez de ser
+        # percorrido por visit() a cada iteração
+        return repeat(self.visit(count), compile_expr(body), self.env)
+
+    def const(self, value):
+        return value
     
     def pi(self):
         return math.pi 
@@ -123,7 +161,8 @@ class CalcEval(Interpreter):
 
     @v_args(inline=False)
     def args(self, tree):
-        return self.visit_children(tree)
+        # Sem argumentos, como em rand(), o único filho é None
+        return [self.visit(arg) for arg in tree.children if arg is not None]
 
     def assign(self, name, value):
         self.env[str(name)] = res = self.visit(value)
@@ -134,6 +173,775 @@ class CalcEval(Interpreter):
         return self.visit_children(tree)[-1]
 
 
+# Profiling
+#
+# ProfiledCalcEval só é usado quando eval() recebe um Profile; sem ele, a
+# avaliação usa CalcEval e não paga nada pela instrumentação.
+class Profile:
+    """
+    Acumula, para cada tipo de nó e cada função chamada, o número de visitas,
+    o tempo total (incluindo os filhos) e o tempo próprio. Também guarda o
+    tempo próprio por pilha de nós, no formato "collapsed" usado por
+    flamegraph.pl e speedscope.
+
+    Uso: eval(src, env, profile=profile) quantas vezes for preciso e depois
+    profile.report() ou profile.write_collapsed("perfil.txt").
+    """
+
+    def __init__(self):
+        self.calls = defaultdict(int)
+        self.total = defaultdict(float)
+        self.own = defaultdict(float)
+        self.stacks = defaultdict(float)
+
+    def add(self, stack: tuple, elapsed: float, own: float):
+        name = stack[-1]
+        self.calls[name] += 1
+        self.own[name] += own
+        self.stacks[stack] += own
+        # Nós recursivos (add dentro de add) só contam no mais externo
+        if name not in stack[:-1]:
+            self.total[name] += elapsed
+
+    def report(self) -> str:
+        """
+        Relatório plano, ordenado pelo tempo total.
+        """
+        lines = [f"{'nó':<16} {'visitas':>8} {'total (ms)':>11} {'próprio (ms)':>13}"]
+        for name in sorted(self.calls, key=self.total.get, reverse=True):
+            lines.append(
+                f"{name:<16} {self.calls[name]:>8} {self.total[name] * 1e3:>11.3f} "
+                f"{self.own[name] * 1e3:>13.3f}"
+            )
+        return "\n".join(lines)
+
+    def collapsed(self) -> str:
+        """
+        Uma linha por pilha, "block;add;funcall;sqrt() 123", com o tempo
+        próprio em microssegundos.
+        """
+        return "\n".join(
+            f"{';'.join(stack)} {round(own * 1e6)}" for stack, own in self.stacks.items()
+        )
+
+    def write_collapsed(self, path):
+        with open(path, "w") as fp:
+            fp.write(self.collapsed() + "\n")
+
+
+@v_args(inline=True)
+class ProfiledCalcEval(CalcEval):
+    """
+    CalcEval que mede cada visita e cada chamada de função.
+    """
+
+    def __init__(self, env, profile: Profile):
+        super().__init__(env)
+        self.profile = profile
+        self.stack = []
+        self.children_time = [0.0]
+
+    def measure(self, name, func, *args):
+        self.stack.append(name)
+        self.children_time.append(0.0)
+        start = perf_counter()
+        try:
+            return func(*args)
+        finally:
+            elapsed = perf_counter() - start
+            own = elapsed - self.children_time.pop()
+            self.children_time[-1] += elapsed
+            self.profile.add(tuple(self.stack), elapsed, own)
+            self.stack.pop()
+
+    def visit(self, tree):
+        return self.measure(tree.data, super().visit, tree)
+
+    def visit_children(self, tree):
+        # O lark visita os filhos sem passar por visit()
+        return [self.visit(child) if isinstance(child, Tree) else child for child in tree.children]
+
+    def funcall(self, name, args):
+        fn = self.var(name)
+        return self.measure(f"{name}()", fn, *self.visit(args))
+
+    def loop(self, count, body):
+        # O corpo é visitado a cada iteração para que seus nós sejam medidos
+        result = None
+        for _ in range(self.visit(count)):
+            result = self.visit(body)
+        return result
+
+
+# Limites de recursos
+#
+# LimitedCalcEval só é usado quando eval() recebe um Limits. O corpo de loop
+# é visitado a cada iteração, para que todos os passos sejam contados.
+class LimitExceeded(Exception):
+    """
+    Avaliação interrompida por exceder um dos limites de Limits. O atributo
+    limit diz qual deles e cost, o consumo até o momento.
+    """
+
+    def __init__(self, limit: str, cost: dict):
+        super().__init__(f"limite de {limit} excedido: {cost}")
+        self.limit = limit
+        self.cost = cost
+
+
+class Limits:
+    """
+    Limites para uma chamada de eval(). Qualquer um pode ser None:
+
+    * max_steps: número de nós visitados;
+    * max_int_bits: tamanho máximo, em bits, dos inteiros calculados;
+    * timeout: tempo máximo em segundos;
+    * max_depth: profundidade máxima de aninhamento da avaliação.
+
+    Depois da avaliação, cost() informa o consumo da última chamada.
+    """
+
+    def __init__(self, max_steps=None, max_int_bits=None, timeout=None, max_depth=None):
+        self.max_steps = max_steps
+        self.max_int_bits = max_int_bits
+        self.timeout = timeout
+        self.max_depth = max_depth
+        self.reset()
+
+    def reset(self):
+        self.steps = 0
+        self.depth = 0
+        self.int_bits = 0
+        self.start = perf_counter()
+        self.deadline = None if self.timeout is None else self.start + self.timeout
+
+    def cost(self) -> dict:
+        return {
+            "steps": self.steps,
+            "depth": self.depth,
+            "int_bits": self.int_bits,
+            "seconds": perf_counter() - self.start,
+        }
+
+    def exceeded(self, limit: str):
+        raise LimitExceeded(limit, self.cost())
+
+    def check_int(self, value):
+        if type(value) is int:
+            bits = value.bit_length()
+            self.int_bits = max(self.int_bits, bits)
+            if self.max_int_bits is not None and bits > self.max_int_bits:
+                self.exceeded("max_int_bits")
+
+
+@v_args(inline=True)
+class LimitedCalcEval(CalcEval):
+    """
+    CalcEval que conta passos, profundidade, tamanho dos inteiros e tempo,
+    e interrompe a avaliação com LimitExceeded.
+    """
+
+    def __init__(self, env, limits: Limits):
+        super().__init__(env)
+        self.limits = limits
+        self.level = 0
+
+    def visit(self, tree):
+        limits = self.limits
+        limits.steps += 1
+        if limits.max_steps is not None and limits.steps > limits.max_steps:
+            limits.exceeded("max_steps")
+        if limits.deadline is not None and perf_counter() > limits.deadline:
+            limits.exceeded("timeout")
+
+        self.level += 1
+        limits.depth = max(limits.depth, self.level)
+        if limits.max_depth is not None and self.level > limits.max_depth:
+            limits.exceeded("max_depth")
+        try:
+            result = super().visit(tree)
+        finally:
+            self.level -= 1
+
+        limits.check_int(result)
+        return result
+
+    def visit_children(self, tree):
+        # O lark visita os filhos sem passar por visit()
+        return [self.visit(child) if isinstance(child, Tree) else child for child in tree.children]
+
+    def pow(self, x, y):
+        # Potências de inteiros são verificadas antes de serem calculadas
+        x, y = self.visit(x), self.visit(y)
+        limits = self.limits
+        if limits.max_int_bits is not None and type(x) is int and type(y) is int and y > 0:
+            if (abs(x).bit_length() - 1) * y > limits.max_int_bits:
+                limits.int_bits = max(limits.int_bits, (abs(x).bit_length() - 1) * y)
+                limits.exceeded("max_int_bits")
+        return x ** y
+
+    def loop(self, count, body):
+        result = None
+        for _ in range(self.visit(count)):
+            result = self.visit(body)
+        return result
+
+
+# Bytecode
+#
+# Cada instrução ocupa duas posições na lista: o opcode e o argumento
+# (ignorado pelas instruções que não precisam dele).
+(
+    CONST, LOAD, STORE, BINARY, NEG, POS, NOT, JUMP, JUMP_IF_FALSE, CALL, POP,
+    JUMP_IF_FALSE_OR_POP, JUMP_IF_TRUE_OR_POP, REPEAT, LOOP, END_LOOP,
+) = range(16)
+
+OPNAMES = [
+    "CONST", "LOAD", "STORE", "BINARY", "NEG", "POS", "NOT",
+    "JUMP", "JUMP_IF_FALSE", "CALL", "POP",
+    "JUMP_IF_FALSE_OR_POP", "JUMP_IF_TRUE_OR_POP", "REPEAT", "LOOP", "END_LOOP",
+]
+
+BINARY_OPS = {
+    "add": operator.add,
+    "sub": operator.sub,
+    "mul": operator.mul,
+    "div": operator.truediv,
+    "pow": operator.pow,
+    "gt": operator.gt,
+    "lt": operator.lt,
+    "ge": operator.ge,
+    "le": operator.le,
+    "eq": operator.eq,
+    "ne": operator.ne,
+}
+BINARY_FUNCS = list(BINARY_OPS.values())
+
+
+class Bytecode(NamedTuple):
+    code: list
+    consts: list
+    names: list
+
+    def run(self, env: dict = None) -> object:
+        """
+        Executa o programa numa máquina de pilha.
+        """
+        if env is None:
+            env = {}
+        env.update(CalcEval.GLOBAL_VARIABLES)
+
+        code, consts, names = self
+        binary = BINARY_FUNCS
+        stack = []
+        push = stack.append
+        pop = stack.pop
+        pc, end = 0, len(code)
+
+        while pc < end:
+            op = code[pc]
+            arg = code[pc + 1]
+            pc += 2
+            if op == LOAD:
+                push(env[names[arg]])
+            elif op == CONST:
+                push(consts[arg])
+            elif op == BINARY:
+                y = pop()
+                stack[-1] = binary[arg](stack[-1], y)
+            elif op == JUMP_IF_FALSE:
+                if not pop():
+                    pc = arg
+            elif op == JUMP:
+                pc = arg
+            elif op == STORE:
+                env[names[arg]] = stack[-1]
+            elif op == CALL:
+                args = stack[len(stack) - arg:]
+                del stack[len(stack) - arg:]
+                stack[-1] = stack[-1](*args)
+            elif op == POP:
+                pop()
+            elif op == LOOP:
+                # Pilha: iterador, resultado da última iteração
+                if next(stack[-2], None) is None:
+                    pc = arg
+            elif op == JUMP_IF_FALSE_OR_POP:
+                if stack[-1]:
+                    pop()
+                else:
+                    pc = arg
+            elif op == JUMP_IF_TRUE_OR_POP:
+                if stack[-1]:
+                    pc = arg
+                else:
+                    pop()
+            elif op == REPEAT:
+                stack[-1] = iter(range(stack[-1]))
+            elif op == END_LOOP:
+                result = pop()
+                stack[-1] = result
+            elif op == NEG:
+                stack[-1] = -stack[-1]
+            elif op == POS:
+                stack[-1] = +stack[-1]
+            elif op == NOT:
+                stack[-1] = not stack[-1]
+        return stack[-1]
+
+    def disassemble(self) -> str:
+        lines = []
+        for pc in range(0, len(self.code), 2):
+            op, arg = self.code[pc:pc + 2]
+            if op == CONST:
+                extra = repr(self.consts[arg])
+            elif op in (LOAD, STORE):
+                extra = self.names[arg]
+            elif op == BINARY:
+                extra = list(BINARY_OPS)[arg]
+            elif op in (JUMP, JUMP_IF_FALSE, CALL, JUMP_IF_FALSE_OR_POP, JUMP_IF_TRUE_OR_POP, LOOP):
+                extra = arg
+            else:
+                extra = ""
+            lines.append(f"{pc:4} {OPNAMES[op]:<20} {extra}")
+        return "\n".join(lines)
+
+
+def make_emit_binop(name):
+    index = list(BINARY_OPS).index(name)
+
+    def emit_binop(self, x, y):
+        self.visit(x)
+        self.visit(y)
+        self.emit(BINARY, index)
+    return emit_binop
+
+
+@v_args(inline=True)
+class BytecodeCompiler(Interpreter):
+    """
+    Percorre a árvore uma única vez e emite o bytecode equivalente ao que
+    CalcEval faria ao avaliá-la.
+    """
+    add = make_emit_binop("add")
+    sub = make_emit_binop("sub")
+    mul = make_emit_binop("mul")
+    div = make_emit_binop("div")
+    pow = make_emit_binop("pow")
+    gt = make_emit_binop("gt")
+    lt = make_emit_binop("lt")
+    ge = make_emit_binop("ge")
+    le = make_emit_binop("le")
+    eq = make_emit_binop("eq")
+    ne = make_emit_binop("ne")
+
+    def __init__(self):
+        super().__init__()
+        self.code = []
+        self.consts = []
+        self.const_indexes = {}
+        self.names = []
+
+    def emit(self, op, arg=0):
+        self.code.extend((op, arg))
+        return len(self.code) - 2
+
+    def const_index(self, value):
+        # O tipo faz parte da chave para que 1, 1.0 e True não se confundam
+        key = (type(value), value)
+        if key not in self.const_indexes:
+            self.const_indexes[key] = len(self.consts)
+            self.consts.append(value)
+        return self.const_indexes[key]
+
+    def name(self, name):
+        name = str(name)
+        if name not in self.names:
+            self.names.append(name)
+        return self.names.index(name)
+
+    def bytecode(self, tree) -> Bytecode:
+        self.visit(tree)
+        return Bytecode(self.code, self.consts, self.names)
+
+    def int(self, tk):
+        self.emit(CONST, self.const_index(int(tk)))
+
+    def const(self, value):
+        self.emit(CONST, self.const_index(value))
+
+    def var(self, name):
+        self.emit(LOAD, self.name(name))
+
+    def neg(self, x):
+        self.visit(x)
+        self.emit(NEG)
+
+    def pos(self, x):
+        self.visit(x)
+        self.emit(POS)
+
+    def not_(self, x):
+        self.visit(x)
+        self.emit(NOT)
+
+    def cond(self, cond, then, other):
+        self.visit(cond)
+        jump_else = self.emit(JUMP_IF_FALSE)
+        self.visit(then)
+        jump_end = self.emit(JUMP)
+        self.code[jump_else + 1] = len(self.code)
+        self.visit(other)
+        self.code[jump_end + 1] = len(self.code)
+
+    def and_(self, x, y):
+        self.visit(x)
+        jump = self.emit(JUMP_IF_FALSE_OR_POP)
+        self.visit(y)
+        self.code[jump + 1] = len(self.code)
+
+    def or_(self, x, y):
+        self.visit(x)
+        jump = self.emit(JUMP_IF_TRUE_OR_POP)
+        self.visit(y)
+        self.code[jump + 1] = len(self.code)
+
+    def loop(self, count, body):
+        self.visit(count)
+        self.emit(REPEAT)
+        self.emit(CONST, self.const_index(None))
+        start = self.emit(LOOP)
+        self.emit(POP)
+        self.visit(body)
+        self.emit(JUMP, start)
+        self.code[start + 1] = len(self.code)
+        self.emit(END_LOOP)
+
+    def funcall(self, name, args):
+        self.emit(LOAD, self.name(name))
+        args = [arg for arg in args.children if arg is not None]
+        for arg in args:
+            self.visit(arg)
+        self.emit(CALL, len(args))
+
+    def assign(self, name, value):
+        self.visit(value)
+        self.emit(STORE, self.name(name))
+
+    @v_args(inline=False)
+    def block(self, tree):
+        for i, expr in enumerate(tree.children):
+            if i:
+                self.emit(POP)
+            self.visit(expr)
+
+
+def compile_bytecode(src: str, optimize: bool = False) -> Bytecode:
+    """
+    Analisa o programa e o compila para bytecode, que pode ser executado
+    várias vezes com ambientes diferentes via Bytecode.run(env).
+    """
+    return BytecodeCompiler().bytecode(parse(src, optimize))
+
+
+# Compilação para funções Python
+#
+# O programa vira o corpo de uma função def program(env), compilada pelo
+# próprio CPython. Variáveis são lidas e escritas diretamente em env.
+PYTHON_OPS = {
+    "add": ast.Add,
+    "sub": ast.Sub,
+    "mul": ast.Mult,
+    "div": ast.Div,
+    "pow": ast.Pow,
+}
+PYTHON_CMP = {
+    "gt": ast.Gt,
+    "lt": ast.Lt,
+    "ge": ast.GtE,
+    "le": ast.LtE,
+    "eq": ast.Eq,
+    "ne": ast.NotEq,
+}
+
+
+def store(env, name, value):
+    env[name] = value
+    return value
+
+
+def repeat(count, body, env):
+    result = None
+    for _ in range(count):
+        result = body(env)
+    return result
+
+
+def make_ast_binop(name):
+    if name in PYTHON_OPS:
+        def ast_binop(self, x, y):
+            return ast.BinOp(self.visit(x), PYTHON_OPS[name](), self.visit(y))
+    else:
+        def ast_binop(self, x, y):
+            return ast.Compare(self.visit(x), [PYTHON_CMP[name]()], [self.visit(y)])
+    return ast_binop
+
+
+def env_item(name, ctx=ast.Load):
+    return ast.Subscript(ast.Name("env", ast.Load()), ast.Constant(str(name)), ctx())
+
+
+@v_args(inline=True)
+class PythonCompiler(Interpreter):
+    """
+    Traduz a árvore para a AST de Python de uma função program(env).
+    """
+    add = make_ast_binop("add")
+    sub = make_ast_binop("sub")
+    mul = make_ast_binop("mul")
+    div = make_ast_binop("div")
+    pow = make_ast_binop("pow")
+    gt = make_ast_binop("gt")
+    lt = make_ast_binop("lt")
+    ge = make_ast_binop("ge")
+    le = make_ast_binop("le")
+    eq = make_ast_binop("eq")
+    ne = make_ast_binop("ne")
+
+    def module(self, tree) -> ast.Module:
+        exprs = tree.children if tree.data == "block" else [tree]
+        body = ast.parse("if env is None: env = {}\nenv.update(GLOBAL_VARIABLES)").body
+        for expr in exprs[:-1]:
+            body.append(self.statement(expr))
+        body.append(ast.Return(self.visit(exprs[-1])))
+        args = ast.arguments([], [ast.arg("env")], None, [], [], None, [ast.Constant(None)])
+        func = ast.FunctionDef("program", args, body, [], None)
+        return ast.fix_missing_locations(ast.Module([func], []))
+
+    def statement(self, expr):
+        # Atribuições cujo valor é descartado viram "env[x] = valor"
+        targets = []
+        while expr.data == "assign":
+            name, expr = expr.children
+            targets.append(env_item(name, ast.Store))
+        if targets:
+            return ast.Assign(targets, self.visit(expr))
+        return ast.Expr(self.visit(expr))
+
+    def int(self, tk):
+        return ast.Constant(int(tk))
+
+    def const(self, value):
+        return ast.Constant(value)
+
+    def var(self, name):
+        return env_item(name)
+
+    def neg(self, x):
+        return ast.UnaryOp(ast.USub(), self.visit(x))
+
+    def pos(self, x):
+        return ast.UnaryOp(ast.UAdd(), self.visit(x))
+
+    def not_(self, x):
+        return ast.UnaryOp(ast.Not(), self.visit(x))
+
+    def cond(self, cond, then, other):
+        return ast.IfExp(self.visit(cond), self.visit(then), self.visit(other))
+
+    def funcall(self, name, args):
+        args = [self.visit(arg) for arg in args.children if arg is not None]
+        return ast.Call(env_item(name), args, [])
+
+    def assign(self, name, value):
+        args = [ast.Name("env", ast.Load()), ast.Constant(str(name)), self.visit(value)]
+        return ast.Call(ast.Name("store", ast.Load()), args, [])
+
+    def and_(self, x, y):
+        return ast.BoolOp(ast.And(), [self.visit(x), self.visit(y)])
+
+    def or_(self, x, y):
+        return ast.BoolOp(ast.Or(), [self.visit(x), self.visit(y)])
+
+    def loop(self, count, body):
+        args = [self.visit(count), self.lambda_(body), ast.Name("env", ast.Load())]
+        return ast.Call(ast.Name("repeat", ast.Load()), args, [])
+
+    def lambda_(self, body) -> ast.Lambda:
+        args = ast.arguments([], [ast.arg("env")], None, [], [], None, [])
+        return ast.Lambda(args, self.visit(body))
+
+
+@v_args(inline=True)
+class NumpyCompiler(PythonCompiler):
+    """
+    Variante de PythonCompiler em que os valores de env podem ser arrays do
+    NumPy: cada nó da árvore vira uma única operação sobre o array inteiro.
+
+    Como where() calcula os dois ramos, as duas alternativas de um
+    if-then-else são sempre avaliadas. Pelo mesmo motivo, and/or não têm
+    curto-circuito nesse modo.
+    """
+
+    def call(self, func, *args):
+        return ast.Call(ast.Name(func, ast.Load()), [self.visit(arg) for arg in args], [])
+
+    def and_(self, x, y):
+        return self.call("logical_and", x, y)
+
+    def or_(self, x, y):
+        return self.call("logical_or", x, y)
+
+    def not_(self, x):
+        return self.call("logical_not", x)
+
+    def cond(self, cond, then, other):
+        return self.call("where", cond, then, other)
+
+
+def numpy_namespace():
+    import numpy as np  # pip install numpy
+
+    variables = {
+        **CalcEval.GLOBAL_VARIABLES,
+        "sqrt": np.sqrt,
+        "sin": np.sin,
+        "cos": np.cos,
+        "ln": np.log,
+    }
+    return {
+        "GLOBAL_VARIABLES": variables,
+        "logical_and": np.logical_and,
+        "logical_or": np.logical_or,
+        "logical_not": np.logical_not,
+        "where": np.where,
+    }
+
+
+def compile(src: str, vectorize: bool = False, optimize: bool = False):
+    """
+    Compila o programa para uma função Python fn(env), que pode ser chamada
+    várias vezes com ambientes diferentes. O código gerado fica em fn.source.
+
+    Com vectorize=True, as variáveis podem ser arrays do NumPy e o programa
+    é avaliado de uma vez para todas as posições. Com optimize=True, as
+    subexpressões constantes são calculadas uma única vez, ao compilar.
+    """
+    compiler = NumpyCompiler() if vectorize else PythonCompiler()
+    module = compiler.module(parse(src, optimize))
+    if vectorize:
+        namespace = numpy_namespace()
+    else:
+        namespace = {"GLOBAL_VARIABLES": CalcEval.GLOBAL_VARIABLES}
+    namespace["store"] = store
+    namespace["repeat"] = repeat
+    exec(builtins.compile(module, "<lang>", "exec"), namespace)
+
+    fn = namespace["program"]
+    fn.source = ast.unparse(module)
+    return fn
+
+
+@lru_cache(PARSE_CACHE_SIZE)
+def compile_expr(tree: Tree):
+    """
+    Compila uma subárvore para uma função Python fn(env), sem o prólogo que
+    insere GLOBAL_VARIABLES em env. É usada por CalcEval no corpo de loop.
+    """
+    expr = ast.fix_missing_locations(ast.Expression(PythonCompiler().lambda_(tree)))
+    namespace = {"store": store, "repeat": repeat}
+    return builtins.eval(builtins.compile(expr, "<lang>", "eval"), namespace)
+
+
+# Otimização
+#
+# Subexpressões constantes são calculadas uma única vez, antes da avaliação.
+IMPURE_FUNCTIONS = {"rand"}
+
+
+@v_args(inline=True)
+class ConstantFolder(ArithmeticFolder):
+    """
+    Substitui por nós "const" as subexpressões cujo valor não depende do
+    ambiente: literais, nomes de GLOBAL_VARIABLES que o programa não
+    redefine, operações entre constantes e funções puras aplicadas a
+    constantes. Também elimina ramos de if com condição constante e as
+    identidades tratadas por ArithmeticFolder.
+    """
+    gt = make_fold_binop("gt", operator.gt)
+    lt = make_fold_binop("lt", operator.lt)
+    ge = make_fold_binop("ge", operator.ge)
+    le = make_fold_binop("le", operator.le)
+    eq = make_fold_binop("eq", operator.eq)
+    ne = make_fold_binop("ne", operator.ne)
+
+    def not_(self, x):
+        return self.fold("not_", operator.not_, x)
+
+    def __init__(self, assigned=()):
+        super().__init__()
+        self.constants = {
+            name: value
+            for name, value in CalcEval.GLOBAL_VARIABLES.items()
+            if name not in IMPURE_FUNCTIONS and name not in assigned
+        }
+
+    def number_type(self, node):
+        # As funções de GLOBAL_VARIABLES vêm de math e retornam sempre float
+        if isinstance(node, Tree) and node.data == "funcall":
+            return float if callable(self.constants.get(str(node.children[0]))) else None
+        return super().number_type(node)
+
+    def int(self, tk):
+        return Tree("const", [int(tk)])
+
+    def var(self, name):
+        value = self.constants.get(str(name))
+        if value is None or callable(value):
+            return Tree("var", [name])
+        return Tree("const", [value])
+
+    def funcall(self, name, args):
+        fn = self.constants.get(str(name))
+        values = [arg for arg in args.children if arg is not None]
+        if callable(fn) and all(map(is_const, values)):
+            try:
+                return Tree("const", [fn(*(arg.children[0] for arg in values))])
+            except Exception:
+                pass
+        return Tree("funcall", [name, args])
+
+    def cond(self, cond, then, other):
+        if is_const(cond):
+            return then if cond.children[0] else other
+        return Tree("cond", [cond, then, other])
+
+    def and_(self, x, y):
+        if is_const(x):
+            return y if x.children[0] else x
+        return Tree("and_", [x, y])
+
+    def or_(self, x, y):
+        if is_const(x):
+            return x if x.children[0] else y
+        return Tree("or_", [x, y])
+
+    def block(self, *exprs):
+        # Constantes no meio de um bloco não têm efeito algum
+        exprs = [expr for expr in exprs[:-1] if not is_const(expr)] + [exprs[-1]]
+        return exprs[0] if len(exprs) == 1 else Tree("block", exprs)
+
+
+def fold_constants(tree: Tree) -> tuple:
+    """
+    Aplica ConstantFolder e retorna a nova árvore e o número de nós
+    removidos.
+    """
+    assigned = {str(node.children[0]) for node in tree.find_data("assign")}
+    folded = ConstantFolder(assigned).transform(tree)
+    return folded, tree_size(tree) - tree_size(folded)
+
+
 exemplos = [
     'x = y = 21; x + y',
     'x = 1; loop 5 x = 2 * x; x',
@@ -144,16 +952,362 @@ exemplos = [
     '4 ^ 3 ^ 2',
 ]
 
-def eval(src: str, env: dict = None) -> object:
+def eval(
+    src: str,
+    env: dict = None,
+    vectorize: bool = False,
+    optimize: bool = False,
+    profile: Profile = None,
+    limits: Limits = None,
+) -> object:
+    """
+    Avalia o programa "src" no ambiente "env" e retorna o valor da última
+    expressão.
+
+    Com limits, a árvore não passa por ConstantFolder mesmo com
+    optimize=True: os limites valem para todos os cálculos, inclusive os que
+    seriam feitos antes da avaliação. limits não pode ser combinado com
+    vectorize nem com profile.
+    """
+    if limits is not None and vectorize:
+        raise ValueError("limits não pode ser usado com vectorize")
+    if limits is not None and profile is not None:
+        raise ValueError("limits não pode ser usado com profile")
     if env is None:
         env = {}
+    if vectorize:
+        return compile(src, vectorize=True, optimize=optimize)(env)
+
+    tree = parse(src, optimize and limits is None)
+    if limits is not None:
+        limits.reset()
+        ctx = LimitedCalcEval(env, limits)
+    elif profile is not None:
+        ctx = ProfiledCalcEval(env, profile)
+    else:
+        ctx = CalcEval(env)
+    return ctx.visit(tree)
+
+
+# Avaliação incremental
+#
+# Cada instrução do bloco é identificada pelo seu texto e pelas "versões" das
+# variáveis que lê. A versão de uma variável é um número que muda sempre que
+# a instrução que a atribuiu é avaliada de novo, então uma edição muda a
+# chave de todas as instruções que dependem dela, direta ou indiretamente, e
+# só essas são avaliadas de novo. As demais reaproveitam o resultado e as
+# atribuições da execução anterior. Instruções que usam funções impuras,
+# como rand(), são sempre avaliadas.
+class IncrementalEval:
+    """
+    Avalia versões sucessivas de um mesmo programa, reaproveitando o que não
+    mudou desde a execução anterior.
+
+    >>> notebook = IncrementalEval({"x": 2})
+    >>> notebook.run("a = x * 10; b = a + 1; c = 5; b + c")
+    26
+    >>> notebook.run("a = x * 10; b = a + 1; c = 6; b + c")  # só c e b + c
+    27
+    """
+
+    def __init__(self, env: dict = None):
+        self.base = {} if env is None else dict(env)
+        self.base_versions = {}
+        self.counter = itertools.count()
+        self.cache = {}
+        self.env = {}
+        self.results = []
+        self.evaluated = 0
+
+    def update(self, **values):
+        """
+        Muda valores do ambiente inicial. Instruções que dependem deles serão
+        avaliadas de novo na próxima execução.
+        """
+        self.base.update(values)
+        for name in values:
+            self.base_versions[name] = next(self.counter)
+
+    def run(self, src: str) -> object:
+        statements = src.split(";")
+        if len(statements) > 1 and not statements[-1].strip():
+            del statements[-1]
+
+        env = dict(self.base)
+        ctx = CalcEval(env)
+        versions = dict(self.base_versions)
+        cache = {}
+        self.results = []
+        self.evaluated = 0
+
+        for text in statements:
+            text = text.strip()
+            tree = parse(text)
+            reads, writes = dependencies(tree)
+            key = (text, tuple((name, versions.get(name)) for name in sorted(reads)))
+
+            if key in self.cache and reads.isdisjoint(IMPURE_FUNCTIONS):
+                result, outputs, version = self.cache[key]
+                env.update(outputs)
+            else:
+                result = ctx.visit(tree)
+                outputs = {name: env[name] for name in writes}
+                version = next(self.counter)
+                self.evaluated += 1
+
+            cache[key] = (result, outputs, version)
+            self.results.append(result)
+            for name in writes:
+                versions[name] = version
+
+        self.cache = cache
+        self.env = env
+        return result
+
+
+def dependencies(tree: Tree) -> tuple:
+    """
+    Retorna os nomes lidos e os nomes atribuídos por uma instrução.
+    """
+    reads, writes = set(), set()
+    for node in tree.iter_subtrees():
+        if node.data in ("var", "funcall"):
+            reads.add(str(node.children[0]))
+        elif node.data == "assign":
+            writes.add(str(node.children[0]))
+    return reads, writes
+
+
+# Avaliação em lote
+#
+# Os processos recebem apenas o texto do programa e o compilam uma vez cada,
+# guardando a função em compiled(). Os ambientes seguem em blocos de
+# "chunksize" jobs com o mesmo programa.
+@lru_cache(PARSE_CACHE_SIZE)
+def compiled(src: str, optimize: bool):
+    return compile(src, optimize=optimize)
+
+
+def eval_chunk(src: str, envs: list, optimize: bool) -> list:
+    try:
+        fn = compiled(src, optimize)
+    except Exception as ex:
+        return [portable_error(ex)] * len(envs)
+
+    results = []
+    for env in envs:
+        try:
+            results.append(fn(env))
+        except Exception as ex:
+            results.append(portable_error(ex))
+    return results
+
+
+def portable_error(ex: Exception) -> Exception:
+    # Erros do lark guardam o estado do parser e não voltam do processo
+    try:
+        pickle.dumps(ex)
+        return ex
+    except Exception:
+        return RuntimeError(f"{type(ex).__name__}: {ex}")
+
+
+def eval_many(
+    jobs,
+    workers: int = None,
+    chunksize: int = 1024,
+    optimize: bool = False,
+    executor: Executor = None,
+) -> list:
+    """
+    Avalia uma sequência de pares (src, env) num pool de processos e retorna
+    os resultados na mesma ordem dos jobs.
+
+    Um job que falha não interrompe os outros: sua posição na lista recebe
+    a exceção correspondente. Ao contrário de eval(), os dicionários env do
+    chamador não são modificados. Com workers=1 tudo roda no processo atual.
+
+    Os jobs rodam em "executor", se for dado, ou num pool de "workers"
+    processos mantido entre as chamadas (veja shared_pool()), evitando
+    iniciar novos processos a cada chamada.
+    """
+    groups = {}
+    for i, (src, env) in enumerate(jobs):
+        indexes, envs = groups.setdefault(src, ([], []))
+        indexes.append(i)
+        envs.append(env)
+
+    chunks = []
+    for src, (indexes, envs) in groups.items():
+        for start in range(0, len(envs), chunksize):
+            chunks.append((src, indexes[start:start + chunksize], envs[start:start + chunksize]))
+
+    srcs = [src for src, _, _ in chunks]
+    envs = [envs for _, _, envs in chunks]
+    flags = [optimize] * len(chunks)
+    if executor is None and workers == 1:
+        envs = [[dict(env) for env in chunk] for chunk in envs]
+        chunk_results = map(eval_chunk, srcs, envs, flags)
+    else:
+        chunk_results = (executor or shared_pool(workers)).map(eval_chunk, srcs, envs, flags)
+
+    results = [None] * sum(len(indexes) for _, indexes, _ in chunks)
+    try:
+        for (_, indexes, _), values in zip(chunks, chunk_results):
+            for i, value in zip(indexes, values):
+                results[i] = value
+    except BrokenProcessPool:
+        # Um processo morreu: o próximo eval_many() cria um pool novo
+        if executor is None:
+            pools.pop(workers, None)
+        raise
+    return results
+
+
+pools = {}
+
+
+def shared_pool(workers: int = None) -> ProcessPoolExecutor:
+    """
+    Retorna o pool com "workers" processos usado por eval_many(), criando-o
+    na primeira chamada. Os processos são encerrados ao final do programa.
+    """
+    try:
+        return pools[workers]
+    except KeyError:
+        pool = pools[workers] = ProcessPoolExecutor(workers)
+        return pool
+
+
+def benchmark():
+    """
+    Compara eval() e CalcEval, que percorrem a árvore a cada avaliação, com
+    o bytecode e a função Python compilados uma única vez e executados com
+    ambientes diferentes.
+    """
+    import timeit
+
+    src = "if x > y then (x - y) * 2 + sqrt(x) else x * y - 1 / (y + 1)"
+    tree = grammar.parse(src)
+    program = compile_bytecode(src)
+    fn = compile(src)
+    envs = [{"x": i % 7, "y": i % 5} for i in range(1000)]
+
+    for env in envs:
+        assert program.run(dict(env)) == fn(dict(env)) == CalcEval(dict(env)).visit(tree)
+
+    tree_time = timeit.timeit(lambda: [CalcEval(env).visit(tree) for env in envs], number=5)
+    vm_time = timeit.timeit(lambda: [program.run(env) for env in envs], number=5)
+    fn_time = timeit.timeit(lambda: [fn(env) for env in envs], number=5)
+    parse_time = timeit.timeit(
+        lambda: [CalcEval(env).visit(grammar.parse(src)) for env in envs], number=5
+    )
+    eval_time = timeit.timeit(lambda: [eval(src, env) for env in envs], number=5)
+    n = 5 * len(envs)
+    print(f"parse:    {parse_time / n * 1e6:.2f}us/eval (analisando a cada vez)")
+    print(f"eval:     {eval_time / n * 1e6:.2f}us/eval ({parse.cache_info()})")
+    print(f"CalcEval: {tree_time / n * 1e6:.2f}us/eval")
+    print(f"bytecode: {vm_time / n * 1e6:.2f}us/eval ({tree_time / vm_time:.1f}x)")
+    print(f"compile:  {fn_time / n * 1e6:.2f}us/eval ({tree_time / fn_time:.1f}x)")
+
+
+def benchmark_vectorized(rows=1_000_000):
+    """
+    Avalia a mesma fórmula sobre uma tabela com "rows" linhas, linha a linha
+    com a função compilada e de uma vez com arrays do NumPy.
+    """
+    import time
+    import numpy as np
+
+    src = "if x > y and not x == 3 then (x - y) * 2 + sqrt(x) else x * y - cos(y) / (y + 1)"
+    rng = np.random.default_rng(0)
+    x = rng.integers(0, 10, rows).astype(float)
+    y = rng.integers(0, 10, rows).astype(float)
+    fn = compile(src)
+    vec = compile(src, vectorize=True)
+
+    start = time.perf_counter()
+    result = vec({"x": x, "y": y})
+    vec_time = time.perf_counter() - start
+
+    sample = min(rows, 100_000)
+    start = time.perf_counter()
+    expected = [fn({"x": a, "y": b}) for a, b in zip(x[:sample].tolist(), y[:sample].tolist())]
+    row_time = (time.perf_counter() - start) * rows / sample
+
+    assert np.allclose(result[:sample], expected)
+    print(f"{rows} linhas: compile {row_time:.2f}s, vectorize {vec_time:.3f}s "
+          f"({row_time / vec_time:.0f}x)")
+
+
+def benchmark_many(size=200_000):
+    """
+    Mede eval_many() com números crescentes de processos.
+    """
+    import time
+
+    srcs = [
+        "if x > y then (x - y) * 2 + sqrt(x) else x * y - 1 / (y + 1)",
+        "a = x ^ 2 + y ^ 2; b = sqrt(a); if b > 5 then b / (x + 1) else cos(a)",
+        "ln(x + 1) * sin(y) + 1 / y",  # falha quando y == 0
+    ]
+    jobs = [(srcs[i % 3], {"x": i % 17, "y": i % 11}) for i in range(size)]
+    expected = eval_many(jobs, workers=1)
+    print(f"{size} jobs, {os.cpu_count()} CPUs, "
+          f"{sum(isinstance(r, Exception) for r in expected)} com erro")
+
+    baseline = None
+    workers = 1
+    while workers <= max(os.cpu_count(), 2):
+        start = time.perf_counter()
+        results = eval_many(jobs, workers=workers)
+        elapsed = time.perf_counter() - start
+        assert list(map(repr, results)) == list(map(repr, expected))
+        baseline = baseline or elapsed
+        print(f"{workers:3} processos: {elapsed:.2f}s ({baseline / elapsed:.1f}x)")
+        workers *= 2
+
+
+# Os exemplos só rodam quando o arquivo é executado diretamente: com o
+# método "spawn", cada processo de eval_many() importa este módulo.
+if __name__ == "__main__":
+    print("EXEMPLOS!")
+    for src in exemplos:
+        print('In: ', src)
+        print('Out:', eval(src))
+        print('Opt:', fold_constants(parse(src))[1], 'nós removidos', end='\n\n')
+        assert eval(src, optimize=True) == eval(src)
+        assert compile_bytecode(src).run() == eval(src)
+        assert compile(src)() == eval(src)
+
+    # x * 1 só é simplificado quando x certamente é um número: True * 1 é 1
+    assert type(eval("x * 1", {"x": True}, optimize=True)) is int
+    assert fold_constants(parse("sqrt(x) * 1"))[0].data == "funcall"
+
+    # Instruções com rand() são avaliadas de novo, assim como as que dependem
+    # delas; as outras, não
+    notebook = IncrementalEval()
+    notebook.run("a = rand(); b = a * 2; c = 3; b")
+    first = notebook.env["b"]
+    notebook.run("a = rand(); b = a * 2; c = 3; b")
+    assert notebook.evaluated == 3 and notebook.env["b"] != first
 
-    ast = grammar.parse(src)
-    ctx = CalcEval(env)
-    return ctx.visit(ast)
+    # Cada visita é contada, inclusive as do corpo de loop
+    profile = Profile()
+    assert eval("x = 0; loop 3 x = x + sqrt(4); x", profile=profile) == 6
+    assert profile.calls["block"] == profile.calls["loop"] == 1
+    assert profile.calls["assign"] == 4 and profile.calls["var"] == 4
+    assert profile.calls["add"] == profile.calls["sqrt()"] == 3
+    print(profile.report(), end="\n\n")
 
+    # Com limits, nada é calculado antes da avaliação, nem com optimize=True
+    try:
+        eval("10 ^ 10 ^ 8", limits=Limits(max_int_bits=1000), optimize=True)
+    except LimitExceeded as ex:
+        assert ex.limit == "max_int_bits"
+    else:
+        raise AssertionError("10 ^ 10 ^ 8 não excedeu max_int_bits")
 
-print("EXEMPLOS!")
-for src in exemplos:
-    print('In: ', src)
-    print('Out:', eval(src), end='\n\n')
\ No newline at end of file
+    benchmark()
+    benchmark_vectorized()
+    benchmark_many()
@@ -1,9 +1,9 @@
 # pip install lark-parser hypothesis
-from lark import Lark
+from grammar_cache import load_parser
 from hypothesis.extra.lark import from_lark
 
 # https://www.em.com.br/app/noticia/cultura/2021/03/01/interna_cultura,1241408/horoscopo-do-dia-01-03-confira-a-previsao-de-hoje-para-seu-signo.shtml
-grammar = Lark(r"""
+grammar = load_parser(r"""
 start : title NL NL intro "." (NL generalidade ".")~2..4
 title : SIGNO
 
@@ -19,8 +19,8 @@ generalidade : "Sua capacidade de se prover, em especial materialmente e finance
 SP    : " "
 NL    : "\n"
 SIGNO   : "Áries" | "Touro" | "Gêmeos" | "Câncer" | "Leão" | "Virgem" | "Libra" | "Escorpião" | "Serpentário" | "Sagitário" | "Capricórnio" | "Aquário" | "Peixes"
-PLANETA : "Mercúrio" | "Vênus" | "Lua" | Marte" | "Júpiter" | "Saturno" | "Urano" | "Netuno" | "Plutão" | "Éris" | "Ceres" | "Haumea" | "Makemake" | "Sedna" 
-""")
+PLANETA : "Mercúrio" | "Vênus" | "Lua" | "Marte" | "Júpiter" | "Saturno" | "Urano" | "Netuno" | "Plutão" | "Éris" | "Ceres" | "Haumea" | "Makemake" | "Sedna" 
+""", parser="lalr", cache_grammar=True)
 
 strategy = from_lark(grammar)
 msg = strategy.example()